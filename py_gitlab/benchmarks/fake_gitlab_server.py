@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+
+class FakeGitlabApp:
+    # minimal ASGI app answering every request with a notes-like json payload,
+    # connections are told apart by the client address hypercorn reports
+    def __init__(self, payload=None, latency_in_sec=0.005):
+        self.body = json.dumps(payload if payload is not None else []).encode()
+        self.latency_in_sec = latency_in_sec
+
+        self.requests_count = 0
+        self.client_addresses = set()
+        self.http_versions = set()
+
+    def reset(self):
+        self.requests_count = 0
+        self.client_addresses = set()
+        self.http_versions = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+
+        self.requests_count += 1
+        self.client_addresses.add(tuple(scope["client"]))
+        self.http_versions.add(scope["http_version"])
+
+        await asyncio.sleep(self.latency_in_sec)
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")],
+        })
+        await send({"type": "http.response.body", "body": self.body})
+
+
+async def start_fake_gitlab_server(app=None, host="127.0.0.1", port=18080):
+    config = Config()
+    config.bind = [f"{host}:{port}"]
+    config.accesslog = None
+    config.errorlog = None
+
+    shutdown_event = asyncio.Event()
+    server_task = asyncio.ensure_future(
+        serve(app, config, shutdown_trigger=shutdown_event.wait))
+
+    # give hypercorn a moment to bind
+    await asyncio.sleep(0.5)
+
+    return shutdown_event, server_task
@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+import ast
+from pathlib import Path
+
+NOTES_FIXTURE_PATH = Path(__file__).resolve().parents[2] / "test.json"
+
+
+def load_notes_fixture(path=NOTES_FIXTURE_PATH):
+    # recorded notes_map of a single MR: {note_id: note}, stored as a python literal
+    notes_map = ast.literal_eval(Path(path).read_text(encoding="utf-8"))
+
+    return list(notes_map.values())
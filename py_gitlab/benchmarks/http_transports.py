@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# run from the py_gitlab dir: python -m benchmarks.http_transports
+import asyncio
+import json
+import time
+from argparse import ArgumentParser
+from benchmarks.fake_gitlab_server import FakeGitlabApp, start_fake_gitlab_server
+from benchmarks.fixtures import load_notes_fixture
+from src.http_service import HttpService, LANE_BULK, LANE_LIMITS
+from src.http_transports import TRANSPORT_AIOHTTP, TRANSPORT_HTTPX
+
+HOST = "127.0.0.1"
+PORT = 18080
+
+TRANSPORT_CONFIGS = {
+    "aiohttp_http1": {"transport": TRANSPORT_AIOHTTP},
+    "httpx_http1": {"transport": TRANSPORT_HTTPX, "http1": True, "http2": False},
+    # the fake server is plain http, so http2 has to be spoken with prior knowledge
+    "httpx_http2": {"transport": TRANSPORT_HTTPX, "http1": False, "http2": True},
+}
+
+
+async def bench_transport(app=None, requests_count=0, concurrency=0, transport_config={}):
+    http_service = HttpService(
+        lane_limits={LANE_BULK: concurrency}, **transport_config)
+    app.reset()
+
+    started_at = time.perf_counter()
+    results = await asyncio.gather(*[
+        http_service.get(url=f"http://{HOST}:{PORT}/api/v4/projects/1/merge_requests/{iid}/notes")
+        for iid in range(requests_count)])
+    elapsed = time.perf_counter() - started_at
+
+    await http_service.close()
+
+    return {
+        "requests": requests_count,
+        "failed": len([result for result in results if result is None]),
+        "seconds": elapsed,
+        "requests_per_sec": requests_count / elapsed,
+        "connections": len(app.client_addresses),
+        "http_versions": sorted(app.http_versions),
+    }
+
+
+async def run(requests_count=0, latency_in_sec=0, concurrency=0):
+    app = FakeGitlabApp(payload=load_notes_fixture(),
+                        latency_in_sec=latency_in_sec)
+    shutdown_event, server_task = await start_fake_gitlab_server(app=app, host=HOST, port=PORT)
+
+    report = {"latency_in_sec": latency_in_sec,
+              "concurrency": concurrency, "transports": {}}
+
+    try:
+        for name, transport_config in TRANSPORT_CONFIGS.items():
+            report["transports"][name] = await bench_transport(
+                app=app, requests_count=requests_count, concurrency=concurrency, transport_config=transport_config)
+    finally:
+        shutdown_event.set()
+        await server_task
+
+    return report
+
+
+def main():
+    parser = ArgumentParser(description='HTTP transports benchmark')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds the fake server waits before answering')
+    parser.add_argument('--concurrency', type=int, default=LANE_LIMITS[LANE_BULK],
+                        help='Permits of the bulk lane, defaults to what GitlabApi runs with')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(requests_count=args.requests,
+                         latency_in_sec=args.latency, concurrency=args.concurrency))
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# run from the py_gitlab dir: python -m benchmarks.logging_overhead
+import copy
+import gc
+import json
+import logging
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+from benchmarks.fixtures import load_notes_fixture
+from src.logger import logger, setup_logging, LazyJson, LOG_FORMAT
+from src.orchestrator import Orchestrator
+
+MRS_COUNT = 200
+CYCLES = 5
+
+
+def build_merge_requests(notes=[], mrs_count=MRS_COUNT):
+    merge_requests = []
+
+    for iid in range(mrs_count):
+        merge_requests.append({
+            "iid": iid,
+            "project_id": 1,
+            "title": f"MR {iid}",
+            "web_url": f"https://gitlab.com/group/project/-/merge_requests/{iid}",
+            "user_notes_count": len(notes),
+            "notes": copy.deepcopy(notes),
+        })
+
+    return merge_requests
+
+
+def run_cycle(orchestrator=None, old_mrs=[], new_mrs=[]):
+    old_lookup = orchestrator.build_notes_lookup(merge_requests=old_mrs)
+    new_lookup = orchestrator.build_notes_lookup(merge_requests=new_mrs)
+
+    diffs = orchestrator.get_diff_notes(
+        old_lookup_table=old_lookup, new_lookup_table=new_lookup)
+
+    # what _post_to_chat logs for every outgoing message
+    for diff in diffs:
+        for note in diff["notes"]:
+            logger.debug("%s", LazyJson({"text": note["body"], "chat_id": 1}))
+
+
+def time_cycles(orchestrator=None, old_mrs=[], new_mrs=[]):
+    # warm up
+    run_cycle(orchestrator=orchestrator, old_mrs=old_mrs, new_mrs=new_mrs)
+
+    gc.collect()
+    gc.disable()
+    started_at = time.perf_counter()
+
+    for _ in range(CYCLES):
+        run_cycle(orchestrator=orchestrator, old_mrs=old_mrs, new_mrs=new_mrs)
+
+    elapsed = time.perf_counter() - started_at
+    gc.enable()
+
+    return elapsed / CYCLES * 1000
+
+
+def configure_legacy_logging(log_file_path=None, stream=None):
+    # what logger.py and cli.py used to do: synchronous handlers at DEBUG
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in [logging.StreamHandler(stream), logging.FileHandler(log_file_path)]:
+        handler.setFormatter(formatter)
+        root_logger.addHandler(handler)
+
+    root_logger.setLevel(logging.DEBUG)
+
+
+def main():
+    notes = load_notes_fixture()
+
+    orchestrator = Orchestrator.__new__(Orchestrator)
+    orchestrator.gitlab_api = SimpleNamespace(current_user={"id": -1})
+
+    old_mrs = build_merge_requests(notes=notes[1:])
+    new_mrs = build_merge_requests(notes=notes)
+
+    results = {"mrs": MRS_COUNT, "notes_per_mr": len(notes), "cycles": CYCLES}
+
+    with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, "w") as devnull:
+        log_file_path = f"{tmp_dir}/bench.log"
+
+        logger.disabled = True
+        results["no_logging_ms_per_cycle"] = time_cycles(
+            orchestrator=orchestrator, old_mrs=old_mrs, new_mrs=new_mrs)
+        logger.disabled = False
+
+        configure_legacy_logging(log_file_path=log_file_path, stream=devnull)
+        results["sync_debug_ms_per_cycle"] = time_cycles(
+            orchestrator=orchestrator, old_mrs=old_mrs, new_mrs=new_mrs)
+
+        for debug in [True, False]:
+            listener = setup_logging(
+                debug=debug, log_file_path=log_file_path, stream=devnull)
+            key = "queue_debug_ms_per_cycle" if debug else "queue_info_ms_per_cycle"
+            results[key] = time_cycles(
+                orchestrator=orchestrator, old_mrs=old_mrs, new_mrs=new_mrs)
+            listener.stop()
+
+    for key in ["sync_debug", "queue_debug", "queue_info"]:
+        results[f"{key}_logging_overhead_ms_per_cycle"] = results[f"{key}_ms_per_cycle"] - \
+            results["no_logging_ms_per_cycle"]
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
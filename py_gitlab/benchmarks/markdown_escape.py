@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# run from the py_gitlab dir: python -m benchmarks.markdown_escape
+import json
+import re
+import timeit
+from benchmarks.fixtures import load_notes_fixture
+from src.telegram_service import format_user_note_message
+from src.utils import escape_markdown_v2, MARKDOWN_V2_SPECIAL_CHARS
+
+LEGACY_CHARS_TO_ESCAPE = ["(", '-', '+', "_", "*",
+                          "[", "]", "`", ".", ')', "{", "}"]
+
+REGEX_ESCAPE_PATTERN = re.compile(f"([{re.escape(MARKDOWN_V2_SPECIAL_CHARS)}])")
+
+MR = {
+    "title": "Refactor shop controller (v2)",
+    "web_url": "https://gitlab.com/group/project/-/merge_requests/694",
+}
+
+
+def legacy_escape(input_str=''):
+    result = input_str
+
+    for char_to_escape in LEGACY_CHARS_TO_ESCAPE:
+        result = re.sub(f"\\{char_to_escape}",
+                        f'\\{char_to_escape}', result)
+
+    return result
+
+
+def regex_escape(input_str=''):
+    # single pass character class alternative to the translate table
+    return REGEX_ESCAPE_PATTERN.sub(r"\\\1", input_str)
+
+
+def bench(func=None, bodies=[], number=200):
+    seconds = timeit.timeit(lambda: [func(body) for body in bodies], number=number)
+
+    return seconds / (number * len(bodies)) * 1e6
+
+
+def main():
+    notes = load_notes_fixture()
+    bodies = [note["body"] for note in notes]
+
+    results = {
+        "notes": len(bodies),
+        "total_chars": sum([len(body) for body in bodies]),
+        "legacy_escape_us_per_note": bench(func=legacy_escape, bodies=bodies),
+        "regex_escape_us_per_note": bench(func=regex_escape, bodies=bodies),
+        "escape_markdown_v2_us_per_note": bench(func=escape_markdown_v2, bodies=bodies),
+        "format_user_note_message_us_per_note": bench(
+            func=lambda body: format_user_note_message(
+                mr=MR, note={"id": 1, "body": body, "author": {"name": "Author"}}),
+            bodies=bodies),
+    }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
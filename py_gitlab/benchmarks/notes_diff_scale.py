@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# run from the py_gitlab dir: python -m benchmarks.notes_diff_scale --mrs 1000,10000,50000
+import gc
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime
+from benchmarks.replay import ReplayWorkload, CURRENT_USER, load_recorded_merge_requests
+from src.gitlab_api import GitlabApi
+from src.orchestrator import Orchestrator
+from src.utils import parse_string_of_integers_to_list
+
+
+def measure(func=None):
+    gc.collect()
+    started_at = time.perf_counter()
+    func()
+    elapsed_in_ms = (time.perf_counter() - started_at) * 1000
+
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"ms": elapsed_in_ms, "peak_mb": peak / 1024 / 1024}
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def bench_workload(workload=None, cycles=1):
+    gitlab_api = GitlabApi(token="replay")
+    gitlab_api.current_user = CURRENT_USER
+
+    orchestrator = Orchestrator.__new__(Orchestrator)
+    orchestrator.gitlab_api = gitlab_api
+
+    old_mrs = workload.merge_requests
+    old_lookup = orchestrator.build_notes_lookup(merge_requests=old_mrs)
+
+    results = []
+    for cycle in range(cycles):
+        new_mrs = workload.next_cycle()
+        new_lookup = orchestrator.build_notes_lookup(merge_requests=new_mrs)
+
+        cycle_results = {
+            "cycle": cycle,
+            "build_notes_lookup": measure(
+                lambda: orchestrator.build_notes_lookup(merge_requests=new_mrs)),
+            "get_diff_notes": measure(
+                lambda: orchestrator.get_diff_notes(old_lookup_table=old_lookup, new_lookup_table=new_lookup)),
+            "user_has_notes_in_mr": measure(
+                lambda: [gitlab_api.user_has_notes_in_mr(mr=mr, user=CURRENT_USER) for mr in new_mrs]),
+            "mr_should_be_unassigned_from": measure(
+                lambda: [orchestrator.mr_should_be_unassigned_from(mr=mr, user=CURRENT_USER) for mr in new_mrs]),
+            "diff_mrs": len(orchestrator.get_diff_notes(old_lookup_table=old_lookup, new_lookup_table=new_lookup)),
+        }
+
+        results.append(cycle_results)
+        old_lookup = new_lookup
+
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='Notes diff path scale benchmark')
+    parser.add_argument('--mrs', type=parse_string_of_integers_to_list, default=[1000, 5000],
+                        help='Comma separated workload sizes in merge requests')
+    parser.add_argument('--notes_per_mr', type=int, default=20)
+    parser.add_argument('--churn', type=float, default=0.05,
+                        help='Fraction of mrs that get a new note every cycle')
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--recorded_mrs', type=str, default=None,
+                        help='Path to a db dump saved by the orchestrator to use as mr templates')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write results json to this file as well')
+    args = parser.parse_args()
+
+    recorded_merge_requests = load_recorded_merge_requests(
+        path=args.recorded_mrs) if args.recorded_mrs else None
+
+    report = {
+        "date": str(datetime.now()),
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "notes_per_mr": args.notes_per_mr,
+        "churn": args.churn,
+        "workloads": [],
+    }
+
+    for mrs_count in args.mrs:
+        workload = ReplayWorkload(mrs_count=mrs_count, notes_per_mr=args.notes_per_mr,
+                                  churn=args.churn, recorded_merge_requests=recorded_merge_requests)
+
+        report["workloads"].append({
+            "mrs": mrs_count,
+            "notes": workload.notes_count(),
+            "cycles": bench_workload(workload=workload, cycles=args.cycles),
+        })
+
+    output = json.dumps(report, indent=2)
+    print(output)
+
+    if args.output:
+        with open(args.output, '+w', encoding="utf-8") as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import copy
+import json
+import random
+from pathlib import Path
+from benchmarks.fixtures import load_notes_fixture
+
+CURRENT_USER = {"id": 1, "username": "current.user", "name": "Current User"}
+OTHER_USERS = [{"id": user_id, "username": f"user{user_id}", "name": f"User {user_id}"}
+               for user_id in range(2, 12)]
+
+MR_TEMPLATE = {
+    "project_id": 1,
+    "source_project_id": 1,
+    "title": "Replayed merge request",
+    "state": "opened",
+    "updated_at": "2022-08-21T12:36:31.119Z",
+    "labels": [],
+}
+
+
+def load_recorded_merge_requests(path=None):
+    # same format Orchestrator dumps to MRS_DB_PATH
+    db_object = json.loads(Path(path).read_text(encoding="utf-8"))
+
+    return db_object["merge_requests"]
+
+
+class ReplayWorkload:
+    def __init__(self, mrs_count=1000, notes_per_mr=20, churn=0.05, seed=0, recorded_merge_requests=None):
+        self.mrs_count = mrs_count
+        self.notes_per_mr = notes_per_mr
+        self.churn = churn
+
+        self.random = random.Random(seed)
+
+        self.note_templates = load_notes_fixture()
+        self.mr_templates = recorded_merge_requests or [MR_TEMPLATE]
+
+        self.next_note_id = 1
+        self.merge_requests = [self._make_merge_request(iid=iid)
+                               for iid in range(1, mrs_count + 1)]
+
+    def _make_note(self, iid=None):
+        note = copy.copy(self.random.choice(self.note_templates))
+        note["id"] = self.next_note_id
+        note["noteable_iid"] = iid
+        note["author"] = self.random.choice(OTHER_USERS)
+        self.next_note_id += 1
+
+        return note
+
+    def _make_merge_request(self, iid=None):
+        mr = copy.copy(self.mr_templates[iid % len(self.mr_templates)])
+        mr["iid"] = iid
+        mr["web_url"] = f"https://gitlab.com/group/project/-/merge_requests/{iid}"
+        mr["author"] = self.random.choice(OTHER_USERS + [CURRENT_USER])
+
+        # a third of the mrs have the current user next to somebody else
+        people = self.random.sample(OTHER_USERS, 2)
+        if iid % 3 == 0:
+            people[0] = CURRENT_USER
+        mr["assignees"] = people[:1 + iid % 2]
+        mr["reviewers"] = people[1:]
+
+        mr["notes"] = [self._make_note(iid=iid)
+                       for _ in range(self.notes_per_mr)]
+        mr["user_notes_count"] = len(mr["notes"])
+
+        return mr
+
+    def next_cycle(self):
+        # returns a new list of mrs where `churn` of them got one new note
+        changed_count = int(self.mrs_count * self.churn)
+        changed_indexes = set(self.random.sample(
+            range(self.mrs_count), changed_count))
+
+        merge_requests = []
+        for index, mr in enumerate(self.merge_requests):
+            if index in changed_indexes:
+                mr = copy.copy(mr)
+                mr["notes"] = mr["notes"] + [self._make_note(iid=mr["iid"])]
+                mr["user_notes_count"] = len(mr["notes"])
+
+            merge_requests.append(mr)
+
+        self.merge_requests = merge_requests
+        return merge_requests
+
+    def notes_count(self):
+        return sum([len(mr["notes"]) for mr in self.merge_requests])
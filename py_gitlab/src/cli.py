@@ -1,20 +1,13 @@
 #!/usr/bin/env python3
 import asyncio
-import logging
+import secrets
 from argparse import ArgumentParser
+from src.http_transports import TRANSPORTS, TRANSPORT_AIOHTTP
+from src.logger import logger, setup_logging
 from src.orchestrator import Orchestrator
 from src.utils import parse_string_of_integers_to_list, parse_string_of_strings_to_list, parse_string_to_domain
 
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='[ %(name)s ] - %(levelname)s : %(message)s')
-
-logger = logging.getLogger("Gitlab")
-
-file_handler = logging.FileHandler("/tmp/py_gitlab.log")
-logger.addHandler(file_handler)
-
-
 parser = ArgumentParser(description='Gitlab cli')
 
 parser.add_argument("-t", '--token', type=str,
@@ -23,6 +16,9 @@ parser.add_argument("-t", '--token', type=str,
 parser.add_argument('--gitlab_domain', type=parse_string_to_domain, default="gitlab.com",
                     help='Custom gitlab domain', required=False)
 
+parser.add_argument('--http_transport', type=str, choices=list(TRANSPORTS.keys()), default=TRANSPORT_AIOHTTP,
+                    help='HTTP client used for gitlab requests. httpx speaks HTTP/2 and multiplexes requests over one connection', required=False)
+
 parser.add_argument("-m", '--merge_requests', type=bool, default=False,
                     help='Check merge requests that are opened by current user', required=False)
 
@@ -44,6 +40,27 @@ parser.add_argument('--telegram_token', type=str,
 parser.add_argument('--chat_id', type=str,
                     help='telegram chat id', required=True)
 
+parser.add_argument('--telegram_digest_window', type=int, default=0,
+                    help='Seconds to collect notes on the same MR into one telegram message (0 disables)', required=False)
+
+parser.add_argument('--telegram_webhook_url', type=str, default=None,
+                    help='Public https url telegram should deliver updates to. Long polling is used when not set', required=False)
+
+parser.add_argument('--telegram_webhook_host', type=str, default="127.0.0.1",
+                    help='Local address for the webhook server to listen on', required=False)
+
+parser.add_argument('--telegram_webhook_port', type=int, default=8443,
+                    help='Local port for the webhook server to listen on', required=False)
+
+parser.add_argument('--telegram_webhook_secret', type=str, default=secrets.token_urlsafe(32),
+                    help='Secret token telegram sends with every webhook request', required=False)
+
+parser.add_argument('--dry_run', type=bool, default=False,
+                    help='Log planned merge request writes instead of sending them', required=False)
+
+parser.add_argument('--profile', type=int, default=0,
+                    help='Run N wait_for_comments cycles under cProfile, write a report and exit', required=False)
+
 parser.add_argument("-u", '--unassign', type=bool, default=False,
                     help='Unassign current user from merge requests with multiple assignees', required=False)
 
@@ -59,9 +76,21 @@ async def run():
         telegram_chat_id=args.chat_id,
         telegram_token=args.telegram_token,
         merge_requests_labels=args.merge_requests_labels,
-        gitlab_domain=args.gitlab_domain)
+        gitlab_domain=args.gitlab_domain,
+        http_transport=args.http_transport,
+        telegram_digest_window_in_sec=args.telegram_digest_window,
+        telegram_webhook_url=args.telegram_webhook_url,
+        telegram_webhook_host=args.telegram_webhook_host,
+        telegram_webhook_port=args.telegram_webhook_port,
+        telegram_webhook_secret=args.telegram_webhook_secret,
+        dry_run_writes=args.dry_run)
 
     try:
+        if args.profile and args.project_ids:
+            logger.info(f"Profiling {args.profile} wait_for_comments cycles")
+            await orchestrator.profile_comments_cycles(project_ids=args.project_ids, cycles=args.profile)
+            return
+
         if args.merge_requests:
             logger.info("Getting merge requests")
             tasks.append(
@@ -88,6 +117,14 @@ async def run():
     except Exception as e:
         logger.error(e)
 
+    finally:
+        await orchestrator.close()
+
 
 def main():
-    asyncio.run(run())
+    log_listener = setup_logging(debug=args.debug)
+
+    try:
+        asyncio.run(run())
+    finally:
+        log_listener.stop()
@@ -1,23 +1,44 @@
 #!/usr/bin/env python3
+import asyncio
+from datetime import date, timedelta
 from src.http_service import HttpService
+from src.http_transports import TRANSPORT_AIOHTTP
 from src.logger import logger
+from src.mr_cache import MergeRequestCache
+from src.mr_write_batch import MergeRequestWriteBatch
+from src.runtime_stats import timed
 from src.utils import string_contains_user_mention
 
 GITLAB_API_PATH = "api/v4"
 
+PER_PAGE = 100
+MAX_PAGES = 20
+
+# how far back the user's own comment events are looked up
+COMMENT_EVENTS_LOOKBACK_DAYS = 180
+
+MENTION_TODO_ACTIONS = ["mentioned", "directly_addressed"]
+
+MR_WRITE_CONCURRENCY = 4
+
 
 class GitlabApi:
-    def __init__(self, token=None, domain="gitlab.com"):
+    def __init__(self, token=None, domain="gitlab.com", http_transport=TRANSPORT_AIOHTTP):
         self.token = token
 
         self.http_service = HttpService(headers={
             "Private-Token": self.token
-        })
+        }, transport=http_transport)
 
         self.base_url = f"https://{domain}/{GITLAB_API_PATH}"
 
         self.current_user = None
 
+        self.mr_cache = MergeRequestCache()
+
+        self.write_semaphore = asyncio.Semaphore(value=MR_WRITE_CONCURRENCY)
+
+    @timed
     async def get_merge_requests(self, scope="created_by_me", project_id=None, with_merge_status_recheck='true'):
         url = f"{self.base_url}/merge_requests" if not project_id else f"{self.base_url}/projects/{project_id}/merge_requests"
 
@@ -26,12 +47,56 @@ class GitlabApi:
         all_merge_requests = await self.http_service.get(url=url, query_params=query_params)
         return all_merge_requests
 
+    @timed
+    async def get_merge_request(self, iid=None, project_id=None):
+        url = f"{self.base_url}/projects/{project_id}/merge_requests/{iid}"
+
+        merge_request = await self.http_service.get(url=url)
+        return merge_request
+
+    @timed
+    async def get_merge_request_with_notes(self, iid=None, project_id=None):
+        # assignee_ids and reviewer_ids writes replace the whole list, so the mr itself
+        # is always read fresh, only unchanged notes are reused from the cache
+        mr = await self.get_merge_request(iid=iid, project_id=project_id)
+
+        if not mr or "iid" not in mr:
+            return None
+
+        await self.load_merge_request_notes(mr=mr)
+        return mr
+
+    async def load_merge_request_notes(self, mr=None):
+        mr["notes"] = []
+
+        if mr["user_notes_count"]:
+            notes = self._get_cached_notes_if_unchanged(mr=mr)
+            if notes is None:
+                notes = await self.get_merge_request_notes(id=mr['iid'], project_id=mr["source_project_id"])
+            if notes:
+                mr["notes"] = notes
+
+        self.mr_cache.set(mr=mr)
+        return mr
+
+    def _get_cached_notes_if_unchanged(self, mr=None):
+        cached_mr = self.mr_cache.get(project_id=mr["project_id"], iid=mr["iid"])
+
+        if cached_mr is None:
+            return None
+
+        if cached_mr["updated_at"] != mr["updated_at"] or cached_mr["user_notes_count"] != mr["user_notes_count"]:
+            return None
+
+        return cached_mr["notes"]
+
+    @timed
     async def get_merge_request_notes(self, id=None, project_id=None):
         url = f"{self.base_url}/projects/{project_id}/merge_requests/{id}/notes"
 
-        merge_requests = await self.http_service.get(url=url)
-        return merge_requests
+        return await self._get_all_pages(url=url)
 
+    @timed
     async def get_current_user(self):
         if not self.current_user:
             url = f"{self.base_url}/user"
@@ -40,17 +105,6 @@ class GitlabApi:
             self.current_user = user
         return self.current_user
 
-    async def get_merge_requests_by_project_ids(self, project_ids=[]):
-        all_mrs = []
-
-        for project_id in project_ids:
-            project_merge_requests = await self.get_merge_requests(project_id=project_id, scope="all")
-
-            for mr in project_merge_requests:
-                all_mrs.append(mr)
-
-        return all_mrs
-
     def user_has_notes_in_mr(self, mr=None, user=None):
         for note in mr["notes"]:
             if not note["system"] and note["author"]["id"] == user["id"] or string_contains_user_mention(note['body'], user["username"]):
@@ -58,88 +112,173 @@ class GitlabApi:
 
         return False
 
-    async def get_merge_requests_relevant_to_user(self, project_ids=[]):
-        relevant_mrs = []
-        # TODO: /merge_requests&scope=all returns 500.
-        # https://gitlab.com/gitlab-org/gitlab/-/issues/342405
-        mrs = await self.get_merge_requests_by_project_ids(project_ids=project_ids)
+    async def _get_all_pages(self, url=None, query_params={}, allow_partial=False):
+        results = []
 
-        for mr in mrs:
-            is_relevant = False
+        for page in range(1, MAX_PAGES + 1):
+            page_results = await self.http_service.get(url=url, query_params={
+                **query_params, "per_page": PER_PAGE, "page": page})
 
-            mr_assignee_ids_set = set([assignee["id"]
-                                      for assignee in mr["assignees"]])
+            # a partial listing would silently drop mrs, fail the whole cycle instead
+            if not isinstance(page_results, list):
+                raise Exception(f"Failed to load page {page} of {url}")
 
-            mr_reviewer_ids_set = set([reviewer["id"]
-                                      for reviewer in mr["reviewers"]])
-            mr["notes"] = []
+            results.extend(page_results)
 
-            if mr["user_notes_count"]:
-                if mr["author"]["id"] == self.current_user["id"]:
-                    is_relevant = True
+            if len(page_results) < PER_PAGE:
+                return results
 
-                notes = await self.get_merge_request_notes(id=mr['iid'], project_id=mr["source_project_id"])
-                if notes:
-                    mr["notes"] = notes
+        if not allow_partial:
+            raise Exception(f"More than {MAX_PAGES} pages to load from {url}")
 
-                if self.user_has_notes_in_mr(mr=mr, user=self.current_user):
-                    is_relevant = True
+        logger.warning(f"Stopped after {MAX_PAGES} pages of {url}, later pages are ignored")
+        return results
 
-            if self.current_user["id"] in mr_assignee_ids_set:
-                logger.debug(
-                    f"MR is relevant for user as he is in assignees array: {mr['title']}")
-                is_relevant = True
+    @timed
+    async def get_filtered_merge_requests(self, project_id=None, filters={}):
+        url = f"{self.base_url}/projects/{project_id}/merge_requests"
 
-            if self.current_user["id"] in mr_reviewer_ids_set:
-                logger.debug(
-                    f"MR is relevant for user as he is in reviewers array: {mr['title']}")
-                is_relevant = True
+        query_params = {"scope": "all", "state": "opened", "wip": "no", **filters}
+        return await self._get_all_pages(url=url, query_params=query_params)
 
-            if is_relevant:
-                relevant_mrs.append(mr)
+    @timed
+    async def get_mentioned_merge_requests(self):
+        url = f"{self.base_url}/todos"
 
-        return relevant_mrs
+        todos_per_action = await asyncio.gather(*[
+            self._get_all_pages(url=url, query_params={"type": "MergeRequest", "action": action})
+            for action in MENTION_TODO_ACTIONS])
 
-    async def update_mr_labels(self,  iid=None, project_id=None, labels=[]):
+        return [todo["target"] for todos in todos_per_action for todo in todos]
 
-        url = f"{self.base_url}/projects/{project_id}/merge_requests/{iid}"
+    @timed
+    async def get_commented_merge_request_keys(self):
+        url = f"{self.base_url}/events"
 
-        json_body = {"labels": labels}
+        after = date.today() - timedelta(days=COMMENT_EVENTS_LOOKBACK_DAYS)
+        # newest first, so hitting the page limit only shortens the lookback
+        events = await self._get_all_pages(url=url, allow_partial=True, query_params={
+            "action": "commented", "after": after.isoformat(), "sort": "desc"})
 
-        result = await self.http_service.put(url=url, json_body=json_body)
+        keys = set()
+        for event in events:
+            note = event.get("note") or {}
 
-        logger.info(f"Updated labels for mr: {iid}. updated labels: {labels}")
-        return result
+            if note.get("noteable_type") == "MergeRequest" and note.get("noteable_iid"):
+                keys.add((event["project_id"], note["noteable_iid"]))
 
-    async def update_mr_assignee_ids(self,  iid=None, project_id=None, assignee_ids=[]):
+        return keys
 
-        url = f"{self.base_url}/projects/{project_id}/merge_requests/{iid}"
+    @timed
+    async def get_open_merge_requests_by_iids(self, project_id=None, iids=[]):
+        merge_requests = []
 
-        json_body = {"assignee_ids": assignee_ids}
+        for start in range(0, len(iids), PER_PAGE):
+            merge_requests.extend(await self.get_filtered_merge_requests(
+                project_id=project_id, filters={"iids[]": iids[start:start + PER_PAGE]}))
 
-        result = await self.http_service.put(url=url, json_body=json_body)
+        return merge_requests
 
-        logger.info(
-            f"Updated assignees for mr: {iid}. updated assignee_ids: {assignee_ids}")
-        return result
+    def _is_open_merge_request_in_projects(self, mr=None, project_ids=[]):
+        if not isinstance(mr, dict) or mr.get("project_id") not in project_ids:
+            return False
 
-    async def update_mr_reviewer_ids(self,  iid=None, project_id=None, reviewer_ids=[]):
+        return mr.get("state") == "opened" and not (mr.get("draft") or mr.get("work_in_progress"))
 
-        url = f"{self.base_url}/projects/{project_id}/merge_requests/{iid}"
+    @timed
+    async def get_merge_requests_relevant_to_user(self, project_ids=[], with_notes=True):
+        # Relevance is pushed down to filtered server side queries. Only mrs where
+        # the user reacted need their notes fetched to be sure.
+        current_user = await self.get_current_user()
+        user_id = current_user["id"]
 
-        json_body = {"reviewer_ids": reviewer_ids}
+        relevant = {}
+        in_doubt = {}
 
-        result = await self.http_service.put(url=url, json_body=json_body)
+        def add_mrs(mrs=[], target=None):
+            for mr in mrs:
+                if self._is_open_merge_request_in_projects(mr=mr, project_ids=project_ids):
+                    target.setdefault((mr["project_id"], mr["iid"]), mr)
 
-        logger.info(
-            f"Updated reviewers for mr: {iid}. updated reviewer_ids: {reviewer_ids}")
+        for project_id in project_ids:
+            authored, assigned, reviewing, reacted = await asyncio.gather(
+                self.get_filtered_merge_requests(project_id=project_id, filters={"author_id": user_id}),
+                self.get_filtered_merge_requests(project_id=project_id, filters={"assignee_id": user_id}),
+                self.get_filtered_merge_requests(project_id=project_id, filters={"reviewer_id": user_id}),
+                self.get_filtered_merge_requests(project_id=project_id, filters={"my_reaction_emoji": "Any"}))
+
+            for mrs in [authored, assigned, reviewing]:
+                add_mrs(mrs=mrs, target=relevant)
+
+            add_mrs(mrs=reacted, target=in_doubt)
+
+        add_mrs(mrs=await self.get_mentioned_merge_requests(), target=relevant)
+
+        # a comment event already proves the user commented, only resolve which mrs are still open
+        commented_iids = {}
+        for project_id, iid in await self.get_commented_merge_request_keys():
+            if project_id in project_ids and (project_id, iid) not in relevant:
+                commented_iids.setdefault(project_id, []).append(iid)
+
+        commented_mrs_per_project = await asyncio.gather(*[
+            self.get_open_merge_requests_by_iids(project_id=project_id, iids=sorted(iids))
+            for project_id, iids in commented_iids.items()])
+
+        for commented_mrs in commented_mrs_per_project:
+            add_mrs(mrs=commented_mrs, target=relevant)
+
+        for key in relevant:
+            in_doubt.pop(key, None)
+
+        logger.debug(
+            f"Relevant mrs from filtered queries: {len(relevant)}, in doubt: {len(in_doubt)}")
+
+        await asyncio.gather(*[self.load_merge_request_notes(mr=mr) for mr in in_doubt.values()])
+
+        for key, mr in in_doubt.items():
+            if self.user_has_notes_in_mr(mr=mr, user=current_user):
+                relevant[key] = mr
+
+        if with_notes:
+            await asyncio.gather(*[self.load_merge_request_notes(mr=mr)
+                                   for mr in relevant.values() if "notes" not in mr])
+
+        self.mr_cache.prune()
+
+        return list(relevant.values())
+
+    @timed
+    async def update_merge_request(self, iid=None, project_id=None, fields={}):
+
+        url = f"{self.base_url}/projects/{project_id}/merge_requests/{iid}"
+
+        result = await self.http_service.put(url=url, json_body=fields)
+        self.mr_cache.write_through(
+            project_id=project_id, iid=iid, updated_mr=result)
+
+        logger.info(f"Updated mr: {iid}. updated fields: {fields}")
         return result
 
+    async def update_mr_labels(self,  iid=None, project_id=None, labels=[]):
+        return await self.update_merge_request(iid=iid, project_id=project_id, fields={"labels": labels})
+
+    async def update_mr_assignee_ids(self,  iid=None, project_id=None, assignee_ids=[]):
+        return await self.update_merge_request(iid=iid, project_id=project_id, fields={"assignee_ids": assignee_ids})
+
+    async def update_mr_reviewer_ids(self,  iid=None, project_id=None, reviewer_ids=[]):
+        return await self.update_merge_request(iid=iid, project_id=project_id, fields={"reviewer_ids": reviewer_ids})
+
+    def create_mr_write_batch(self, dry_run=False):
+        return MergeRequestWriteBatch(gitlab_api=self, semaphore=self.write_semaphore, dry_run=dry_run)
+
+    @timed
     async def unsubscribe_from_mr(self, iid=None, project_id=None):
 
         url = f"{self.base_url}/projects/{project_id}/merge_requests/{iid}/unsubscribe"
 
         result = await self.http_service.post(url=url)
+        self.mr_cache.write_through(
+            project_id=project_id, iid=iid, updated_mr=result)
 
         logger.info(
             f"Unsubscribed from mr : {iid}.")
@@ -1,73 +1,110 @@
 #!/usr/bin/env python3
 import asyncio
-import aiohttp
+from contextlib import contextmanager
+from contextvars import ContextVar
+from src.http_transports import create_transport, TRANSPORT_AIOHTTP
 from src.logger import logger
 
-semaphore = asyncio.Semaphore(value=10)
+SUPPORTED_METHODS = {"GET", "POST", "PUT", "PATCH"}
+
+# long polls park a connection for their whole timeout, interactive work
+# (telegram sends, button callbacks) must not queue behind background fetches
+LANE_LONG_POLL = "long_poll"
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+
+LANE_LIMITS = {
+    LANE_LONG_POLL: 1,
+    LANE_INTERACTIVE: 4,
+    LANE_BULK: 6,
+}
+
+lane_semaphores = {lane: asyncio.Semaphore(value=limit)
+                   for lane, limit in LANE_LIMITS.items()}
+
+current_lane = ContextVar("current_lane", default=None)
+
+
+@contextmanager
+def use_lane(lane=None):
+    token = current_lane.set(lane)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
 
 
 class HttpService:
-    def __init__(self, headers=None):
+    def __init__(self, headers=None, default_lane=LANE_BULK, lane_limits=None, transport=TRANSPORT_AIOHTTP, **transport_kwargs):
         self.headers = headers if headers else {}
         # TODO pick random
         self.headers["User-Agent"] = "Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10.5; en-US; rv:1.9.0.5) Gecko/2008120121 Firefox/3.0.54"
 
-    async def __request(self, url=None, query_params={}, json_body=None, method="GET"):
-        await semaphore.acquire()
-        session = aiohttp.ClientSession(headers=self.headers)
+        self.default_lane = default_lane
+
+        # lanes given in lane_limits get permits of their own, the rest are shared process wide
+        self.lane_semaphores = {**lane_semaphores, **{
+            lane: asyncio.Semaphore(value=limit) for lane, limit in (lane_limits or {}).items()}}
+
+        self.transport = create_transport(
+            name=transport, headers=self.headers, **transport_kwargs)
+
+    def _resolve_lane(self, lane=None):
+        return lane or current_lane.get() or self.default_lane
+
+    async def __request(self, url=None, query_params={}, json_body=None, method="GET", lane=None):
+        lane = self._resolve_lane(lane=lane)
+        semaphore = self.lane_semaphores[lane]
+
+        if semaphore.locked():
+            logger.debug(f"Waiting for a free connection in {lane} lane: {url}")
+
+        async with semaphore:
+            return await self.__send(url=url, query_params=query_params, json_body=json_body, method=method)
+
+    async def __send(self, url=None, query_params={}, json_body=None, method="GET"):
         result = None
         try:
-            query_params_array = [(k, query_params[k])
-                                  for k in query_params.keys()]
-
-            request_kargs = {
-                "url": url,
-                "params": query_params_array,
-                "json": json_body
-            }
-
-            response = None
-            if method == "GET":
-                response = await session.get(**request_kargs)
-            elif method == 'POST':
-                response = await session.post(**request_kargs)
-            elif method == 'PUT':
-                response = await session.put(**request_kargs)
-            elif method == 'PATCH':
-                response = await session.patch(**request_kargs)
-            else:
-                semaphore.release()
-                await session.close()
+            if method not in SUPPORTED_METHODS:
                 raise Exception(f"Unkown request method: {method}")
 
-            logger.debug(response.url)
-            if response:
-                result = await response.json()
-            else:
+            # list values repeat their key, e.g. iids[]=1&iids[]=2
+            query_params_array = [(k, item)
+                                  for k, v in query_params.items()
+                                  for item in (v if isinstance(v, list) else [v])]
+
+            response_url, result = await self.transport.request(method=method,
+                                                                url=url,
+                                                                query_params=query_params_array,
+                                                                json_body=json_body)
+
+            logger.debug(response_url)
+            if result is None:
                 raise Exception("Got empty response")
 
         except Exception as e:
             logger.error(e)
 
-        await session.close()
-        semaphore.release()
         return result
 
-    async def get(self, url=None, query_params={}):
-        result = await self.__request(url=url, query_params=query_params, method="GET")
+    async def close(self):
+        await self.transport.close()
+
+    async def get(self, url=None, query_params={}, lane=None):
+        result = await self.__request(url=url, query_params=query_params, method="GET", lane=lane)
         return result
 
-    async def post(self, url=None, query_params={}, json_body=None):
+    async def post(self, url=None, query_params={}, json_body=None, lane=None):
         result = await self.__request(url=url, query_params=query_params,
-                                      json_body=json_body, method="POST")
+                                      json_body=json_body, method="POST", lane=lane)
         return result
 
-    async def patch(self, url=None, query_params={}, json_body=None):
+    async def patch(self, url=None, query_params={}, json_body=None, lane=None):
         result = await self.__request(url=url, query_params=query_params,
-                                      json_body=json_body, method="PATCH")
+                                      json_body=json_body, method="PATCH", lane=lane)
         return result
 
-    async def put(self, url=None, query_params={}, json_body=None):
+    async def put(self, url=None, query_params={}, json_body=None, lane=None):
         result = await self.__request(
-            url=url, query_params=query_params, json_body=json_body, method="PUT")
+            url=url, query_params=query_params, json_body=json_body, method="PUT", lane=lane)
         return result
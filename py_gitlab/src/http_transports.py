@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+from abc import ABC, abstractmethod
+import aiohttp
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+TRANSPORT_AIOHTTP = "aiohttp"
+TRANSPORT_HTTPX = "httpx"
+
+# a hung connection must not hold a lane permit forever
+REQUEST_TIMEOUT_IN_SEC = 300
+
+
+class HttpTransport(ABC):
+    @abstractmethod
+    async def request(self, method=None, url=None, query_params=[], json_body=None):
+        pass
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+
+class AiohttpTransport(HttpTransport):
+    # HTTP/1.1 with keep-alive, concurrent requests to a host need one connection each
+    def __init__(self, headers=None):
+        self.headers = headers
+        self.session = None
+
+    def _get_session(self):
+        # sessions have to be created inside the running loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_IN_SEC))
+
+        return self.session
+
+    async def request(self, method=None, url=None, query_params=[], json_body=None):
+        response = await self._get_session().request(method, url, params=query_params, json=json_body)
+
+        async with response:
+            return response.url, await response.json()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class HttpxTransport(HttpTransport):
+    # HTTP/2 multiplexes concurrent requests to a host over a single connection
+    def __init__(self, headers=None, http1=True, http2=True):
+        if httpx is None:
+            raise Exception(
+                "httpx transport requires httpx: pip install 'httpx[http2]'")
+
+        self.headers = headers
+        self.http1 = http1
+        self.http2 = http2
+        self.client = None
+
+    def _get_client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                headers=self.headers, http1=self.http1, http2=self.http2,
+                timeout=httpx.Timeout(REQUEST_TIMEOUT_IN_SEC))
+
+        return self.client
+
+    async def request(self, method=None, url=None, query_params=[], json_body=None):
+        response = await self._get_client().request(method, url, params=query_params, json=json_body)
+
+        return response.url, response.json()
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+TRANSPORTS = {
+    TRANSPORT_AIOHTTP: AiohttpTransport,
+    TRANSPORT_HTTPX: HttpxTransport,
+}
+
+
+def create_transport(name=TRANSPORT_AIOHTTP, headers=None, **kwargs):
+    if name not in TRANSPORTS:
+        raise Exception(f"Unknown http transport: {name}")
+
+    return TRANSPORTS[name](headers=headers, **kwargs)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import asyncio
+from collections import deque
+from src.logger import logger
+
+
+class KeyedWorkerPool:
+    # Jobs with the same key run one after another in submit order,
+    # jobs with different keys run concurrently on up to `workers` workers.
+    def __init__(self, workers=4):
+        # key -> deque of (job_id, job factory)
+        self._pending = {}
+        self._running_job_ids = {}
+        # keys that are waiting in _ready_keys or being drained by a worker
+        self._scheduled_keys = set()
+        self._ready_keys = asyncio.Queue()
+
+        self._workers = [asyncio.ensure_future(self._run_worker())
+                         for _ in range(workers)]
+
+    def _is_duplicate(self, key=None, job_id=None):
+        if self._running_job_ids.get(key) == job_id:
+            return True
+
+        return any([pending_job_id == job_id for pending_job_id, _ in self._pending.get(key, [])])
+
+    def submit(self, key=None, job_id=None, job_factory=None):
+        if job_id is not None and self._is_duplicate(key=key, job_id=job_id):
+            logger.debug(f"Dropping duplicate job {job_id} for {key}")
+            return False
+
+        self._pending.setdefault(key, deque()).append((job_id, job_factory))
+
+        if key not in self._scheduled_keys:
+            self._scheduled_keys.add(key)
+            self._ready_keys.put_nowait(key)
+
+        return True
+
+    async def _run_worker(self):
+        while True:
+            key = await self._ready_keys.get()
+
+            jobs = self._pending[key]
+            while jobs:
+                job_id, job_factory = jobs.popleft()
+                self._running_job_ids[key] = job_id
+
+                try:
+                    await job_factory()
+                except Exception as e:
+                    logger.error(e)
+
+                del self._running_job_ids[key]
+
+            del self._pending[key]
+            self._scheduled_keys.discard(key)
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
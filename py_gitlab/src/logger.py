@@ -1,16 +1,53 @@
 #!/usr/bin/env python3
+import json
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import queue
+import sys
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 from src.config import LOGS_DIR
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='[ %(name)s ] - %(levelname)s : %(message)s')
+LOG_FORMAT = '[ %(name)s ] - %(levelname)s : %(message)s'
+
+LOG_FILE_PATH = f"{LOGS_DIR}/py_gitlab.log"
 
 logger = logging.getLogger("Gitlab")
 
-file_handler = TimedRotatingFileHandler(
-    f"{LOGS_DIR}/py_gitlab.log", when="midnight", interval=1)
+log_queue = queue.SimpleQueue()
+
+
+class LazyJson:
+    # serialised only when the record is actually emitted
+    def __init__(self, obj=None):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, indent=2)
+
+
+def setup_logging(debug=False, log_file_path=LOG_FILE_PATH, stream=sys.stderr):
+    level = logging.DEBUG if debug else logging.INFO
+
+    formatter = logging.Formatter(LOG_FORMAT)
+
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(formatter)
+
+    file_handler = TimedRotatingFileHandler(
+        log_file_path, when="midnight", interval=1)
+    file_handler.suffix = "%Y%m%d"
+    file_handler.setFormatter(formatter)
+
+    # the event loop only puts records on the queue, handlers do their IO on the listener thread
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(level)
+
+    # keep noisy dependencies at INFO even with --debug
+    logging.getLogger("aiohttp").setLevel(max(level, logging.INFO))
 
-file_handler.suffix = "%Y%m%d"
+    listener = QueueListener(log_queue, stream_handler, file_handler)
+    listener.start()
 
-logger.addHandler(file_handler)
+    return listener
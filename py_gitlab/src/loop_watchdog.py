@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from src.logger import logger
+from src.runtime_stats import percentile
+
+
+class LoopWatchdog:
+    # The loop side sleeps for `interval_in_sec` and records how late it woke up.
+    # A watcher thread catches stalls while they happen and captures the loop's stack.
+    def __init__(self, interval_in_sec=0.1, stall_threshold_in_sec=0.25, samples_size=3000, stalls_size=10):
+        self.interval_in_sec = interval_in_sec
+        self.stall_threshold_in_sec = stall_threshold_in_sec
+
+        self.lag_samples = deque(maxlen=samples_size)
+        self.stalls = deque(maxlen=stalls_size)
+        # stalls are appended by the watcher thread and read from the loop
+        self._stalls_lock = threading.Lock()
+
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._watcher_thread = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+
+        self._task = asyncio.ensure_future(self._run_lag_probe())
+
+        self._watcher_thread = threading.Thread(
+            target=self._run_watcher, name="loop-watchdog", daemon=True)
+        self._watcher_thread.start()
+
+    async def _run_lag_probe(self):
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(self.interval_in_sec)
+
+            now = time.monotonic()
+            lag = max(now - started_at - self.interval_in_sec, 0)
+            self.lag_samples.append(lag)
+
+            # the watcher only saw the stall while it lasted, fill in its full length
+            with self._stalls_lock:
+                if self.stalls and self.stalls[-1]["heartbeat"] == self._heartbeat:
+                    self.stalls[-1]["lag_ms"] = round(lag * 1000, 1)
+
+            self._heartbeat = now
+
+    def _capture_loop_stack(self):
+        frame = sys._current_frames().get(self._loop_thread_id)
+
+        if frame is None:
+            return None
+
+        return "".join(traceback.format_stack(frame))
+
+    def _run_watcher(self):
+        reported_heartbeat = None
+
+        while not self._stop_event.wait(self.stall_threshold_in_sec / 2):
+            heartbeat = self._heartbeat
+            lag = time.monotonic() - heartbeat - self.interval_in_sec
+
+            # one report per stall, the heartbeat moves again once the loop is free
+            if lag < self.stall_threshold_in_sec or heartbeat == reported_heartbeat:
+                continue
+
+            reported_heartbeat = heartbeat
+            stack = self._capture_loop_stack()
+
+            with self._stalls_lock:
+                self.stalls.append({
+                    "date": str(datetime.now()),
+                    "heartbeat": heartbeat,
+                    "detected_after_ms": round(lag * 1000, 1),
+                    "lag_ms": round(lag * 1000, 1),
+                    "stack": stack,
+                })
+
+            logger.warning(
+                "Event loop blocked for %.0f ms, loop thread stack:\n%s", lag * 1000, stack)
+
+    def summary(self):
+        lag_samples_in_ms = [lag * 1000 for lag in self.lag_samples]
+
+        with self._stalls_lock:
+            stalls = [{key: value for key, value in stall.items() if key != "heartbeat"}
+                      for stall in self.stalls]
+
+        return {
+            "samples": len(lag_samples_in_ms),
+            "p50_ms": percentile(lag_samples_in_ms, 0.5),
+            "p95_ms": percentile(lag_samples_in_ms, 0.95),
+            "p99_ms": percentile(lag_samples_in_ms, 0.99),
+            "max_ms": max(lag_samples_in_ms, default=None),
+            "stall_threshold_ms": self.stall_threshold_in_sec * 1000,
+            "stalls": stalls,
+        }
+
+    async def stop(self):
+        self._stop_event.set()
+
+        if self._task:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import time
+from src.logger import logger
+
+
+class MergeRequestCache:
+    def __init__(self, ttl_in_sec=120):
+        self.ttl_in_sec = ttl_in_sec
+        # (project_id, iid) -> (stored_at, mr)
+        self._entries = {}
+
+    @staticmethod
+    def _key(project_id=None, iid=None):
+        return (int(project_id), int(iid))
+
+    def get(self, project_id=None, iid=None):
+        key = self._key(project_id=project_id, iid=iid)
+        entry = self._entries.get(key)
+
+        if not entry:
+            return None
+
+        stored_at, mr = entry
+
+        if time.monotonic() - stored_at > self.ttl_in_sec:
+            del self._entries[key]
+            return None
+
+        return mr
+
+    def set(self, mr=None):
+        if not mr or "iid" not in mr or "project_id" not in mr:
+            return
+
+        key = self._key(project_id=mr["project_id"], iid=mr["iid"])
+        self._entries[key] = (time.monotonic(), mr)
+
+    def write_through(self, project_id=None, iid=None, updated_mr=None):
+        # PUT responses carry the updated MR but not its notes,
+        # so keep the cached notes and drop the entry on anything unexpected
+        key = self._key(project_id=project_id, iid=iid)
+        cached_mr = self.get(project_id=project_id, iid=iid)
+
+        if not isinstance(updated_mr, dict) or updated_mr.get("iid") != key[1] or cached_mr is None:
+            self.invalidate(project_id=project_id, iid=iid)
+            return
+
+        updated_mr["notes"] = cached_mr.get("notes", [])
+        self._entries[key] = (time.monotonic(), updated_mr)
+
+    def invalidate(self, project_id=None, iid=None):
+        key = self._key(project_id=project_id, iid=iid)
+
+        if self._entries.pop(key, None) is not None:
+            logger.debug(f"Invalidated cached mr: {key}")
+
+    def prune(self):
+        now = time.monotonic()
+        expired_keys = [key for key, (stored_at, _) in self._entries.items()
+                        if now - stored_at > self.ttl_in_sec]
+
+        for key in expired_keys:
+            del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
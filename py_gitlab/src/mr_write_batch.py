@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import asyncio
+from src.logger import logger
+
+WRITE_STATUS_UPDATED = "updated"
+WRITE_STATUS_NOOP = "noop"
+WRITE_STATUS_FAILED = "failed"
+WRITE_STATUS_DRY_RUN = "dry_run"
+
+
+def get_current_field_value(mr=None, field=None):
+    if field == "assignee_ids":
+        return set([assignee["id"] for assignee in mr.get("assignees", [])])
+
+    if field == "reviewer_ids":
+        return set([reviewer["id"] for reviewer in mr.get("reviewers", [])])
+
+    if field == "labels":
+        return set(mr.get("labels", []))
+
+    return mr.get(field)
+
+
+def field_changes(mr=None, fields={}):
+    if not mr:
+        return dict(fields)
+
+    changes = {}
+    for field, value in fields.items():
+        current_value = get_current_field_value(mr=mr, field=field)
+        new_value = set(value) if isinstance(current_value, set) else value
+
+        if current_value != new_value:
+            changes[field] = value
+
+    return changes
+
+
+def is_merge_request_response(response=None):
+    return isinstance(response, dict) and "iid" in response
+
+
+class MergeRequestWriteBatch:
+    # Collects field changes per mr, then writes each mr with a single PUT
+    def __init__(self, gitlab_api=None, semaphore=None, dry_run=False):
+        self.gitlab_api = gitlab_api
+        self.semaphore = semaphore
+        self.dry_run = dry_run
+
+        # (project_id, iid) -> {"mr": mr, "fields": {}, "unsubscribe": bool}
+        self.pending = {}
+
+    def stage(self, project_id=None, iid=None, mr=None, fields={}, unsubscribe=False):
+        if mr:
+            project_id, iid = mr["project_id"], mr["iid"]
+
+        key = (project_id, iid)
+        write = self.pending.setdefault(
+            key, {"mr": None, "fields": {}, "unsubscribe": False})
+
+        write["mr"] = mr or write["mr"] or self.gitlab_api.mr_cache.get(
+            project_id=project_id, iid=iid)
+        write["fields"].update(fields)
+        write["unsubscribe"] = write["unsubscribe"] or unsubscribe
+
+        return key
+
+    def plan(self):
+        planned = {}
+
+        for key, write in self.pending.items():
+            mr = write["mr"]
+            changes = field_changes(mr=mr, fields=write["fields"])
+            # subscribed is only known when we have the mr, unknown means we have to ask
+            unsubscribe = write["unsubscribe"] and (
+                not mr or mr.get("subscribed", True))
+
+            planned[key] = {
+                "project_id": key[0],
+                "iid": key[1],
+                "fields": changes,
+                "unsubscribe": unsubscribe,
+                "calls": int(bool(changes)) + int(unsubscribe),
+            }
+
+        return planned
+
+    async def _execute_write(self, planned_write=None):
+        project_id, iid = planned_write["project_id"], planned_write["iid"]
+        result = {**planned_write, "status": WRITE_STATUS_NOOP, "result": None}
+
+        if not planned_write["calls"]:
+            return result
+
+        async with self.semaphore:
+            if planned_write["fields"]:
+                result["result"] = await self.gitlab_api.update_merge_request(
+                    iid=iid, project_id=project_id, fields=planned_write["fields"])
+
+                if not is_merge_request_response(result["result"]):
+                    result["status"] = WRITE_STATUS_FAILED
+                    return result
+
+            if planned_write["unsubscribe"]:
+                unsubscribe_result = await self.gitlab_api.unsubscribe_from_mr(iid=iid, project_id=project_id)
+
+                if not is_merge_request_response(unsubscribe_result):
+                    result["status"] = WRITE_STATUS_FAILED
+                    return result
+
+                result["result"] = result["result"] or unsubscribe_result
+
+        result["status"] = WRITE_STATUS_UPDATED
+        return result
+
+    async def execute(self):
+        planned = self.plan()
+        self.pending = {}
+
+        planned_calls = sum([write["calls"] for write in planned.values()])
+
+        if self.dry_run:
+            logger.info(
+                f"Dry run: {planned_calls} write calls planned for {len(planned)} mrs")
+            return {key: {**write, "status": WRITE_STATUS_DRY_RUN, "result": None}
+                    for key, write in planned.items()}
+
+        logger.debug(
+            f"Executing {planned_calls} write calls for {len(planned)} mrs")
+
+        results = await asyncio.gather(*[self._execute_write(planned_write=write)
+                                         for write in planned.values()])
+
+        return dict(zip(planned.keys(), results))
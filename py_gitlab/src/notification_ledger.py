@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from src.logger import logger
+
+LEDGER_VERSION = 1
+
+EVENT_ASK_TO_UNASSIGN = "ask_to_unassign"
+
+
+def note_event(note=None):
+    return f"note:{note['id']}"
+
+
+class NotificationLedger:
+    # Remembers which (project_id, iid, event) notifications were already sent.
+    # Oldest entries are evicted first, by age (ttl) and by count (max_entries).
+    def __init__(self, path=None, ttl_in_sec=7 * 24 * 60 * 60, max_entries=20000, save_delay_in_sec=1):
+        self.path = path
+        self.ttl_in_sec = ttl_in_sec
+        self.max_entries = max_entries
+        self.save_delay_in_sec = save_delay_in_sec
+
+        # (project_id, iid, event) -> sent_at, in insertion order
+        self.entries = OrderedDict()
+        self._save_task = None
+
+        self.load()
+
+    @staticmethod
+    def _key(project_id=None, iid=None, event=None):
+        return (int(project_id), int(iid), event)
+
+    def _evict(self, now=None):
+        while self.entries:
+            key, sent_at = next(iter(self.entries.items()))
+
+            if len(self.entries) <= self.max_entries and now - sent_at <= self.ttl_in_sec:
+                break
+
+            del self.entries[key]
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'r', encoding="utf-8") as f:
+                ledger = json.loads(f.read())
+
+            if ledger.get("version") != LEDGER_VERSION:
+                logger.warning(f"Ignoring notifications ledger with unknown version: {self.path}")
+                return
+
+            for project_id, iid, event, sent_at in ledger["entries"]:
+                self.entries[(project_id, iid, event)] = sent_at
+
+            self._evict(now=time.time())
+            logger.info(f"Loaded {len(self.entries)} sent notifications from {self.path}")
+        except Exception as e:
+            logger.error(e)
+
+    def contains(self, project_id=None, iid=None, event=None):
+        key = self._key(project_id=project_id, iid=iid, event=event)
+        sent_at = self.entries.get(key)
+
+        if sent_at is None:
+            return False
+
+        if time.time() - sent_at > self.ttl_in_sec:
+            del self.entries[key]
+            return False
+
+        return True
+
+    def add(self, project_id=None, iid=None, event=None):
+        key = self._key(project_id=project_id, iid=iid, event=event)
+        now = time.time()
+
+        self.entries.pop(key, None)
+        self.entries[key] = now
+        self._evict(now=now)
+
+        self._schedule_save()
+
+    def _schedule_save(self):
+        if not self.path or (self._save_task and not self._save_task.done()):
+            return
+
+        self._save_task = asyncio.ensure_future(self._save_later())
+
+    async def _save_later(self):
+        # a burst of sends ends up in a single write
+        await asyncio.sleep(self.save_delay_in_sec)
+        await self.save()
+
+    def _write(self, serialized_ledger=None):
+        tmp_path = f"{self.path}.tmp"
+
+        with open(tmp_path, '+w', encoding="utf-8") as f:
+            f.write(serialized_ledger)
+
+        os.replace(tmp_path, self.path)
+
+    async def save(self):
+        if not self.path:
+            return
+
+        serialized_ledger = json.dumps({
+            "version": LEDGER_VERSION,
+            "entries": [[project_id, iid, event, round(sent_at)]
+                        for (project_id, iid, event), sent_at in self.entries.items()]
+        }, separators=(",", ":"))
+
+        try:
+            await asyncio.to_thread(self._write, serialized_ledger)
+        except Exception as e:
+            logger.error(e)
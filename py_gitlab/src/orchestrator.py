@@ -2,35 +2,72 @@
 import asyncio
 import sys
 import json
+import cProfile
+import pstats
 from datetime import datetime
 from random import randint
 from src.logger import logger
 from src.utils import retry_on_fail, get_notes_hash
 from src.gitlab_api import GitlabApi
+from src.http_transports import TRANSPORT_AIOHTTP
+from src.mr_write_batch import WRITE_STATUS_UPDATED, WRITE_STATUS_NOOP
 from src.telegram_service import TelegramService
 from src.config import PROJECT_DIR
+from src.loop_watchdog import LoopWatchdog
+from src.runtime_stats import RuntimeStats, timed, span
 
 APPROVED_MR_MESSAGE_BODY = "approved this merge request"
 
 
 class Orchestrator:
     MRS_DB_PATH = f'{PROJECT_DIR}/db'
+    NOTIFICATIONS_LEDGER_PATH = f'{PROJECT_DIR}/sent_notifications.json'
+    STATS_PATH = f'{PROJECT_DIR}/stats.json'
+    PROFILES_DIR = f'{PROJECT_DIR}'
 
     def __init__(self,
                  gitlab_token=None,
                  telegram_chat_id=None,
                  telegram_token=None,
                  merge_requests_labels=[],
-                 gitlab_domain=None):
-        self.gitlab_api = GitlabApi(token=gitlab_token, domain=gitlab_domain)
+                 gitlab_domain=None,
+                 http_transport=TRANSPORT_AIOHTTP,
+                 telegram_digest_window_in_sec=0,
+                 telegram_webhook_url=None,
+                 telegram_webhook_host="127.0.0.1",
+                 telegram_webhook_port=8443,
+                 telegram_webhook_secret=None,
+                 dry_run_writes=False):
+        self.gitlab_api = GitlabApi(
+            token=gitlab_token, domain=gitlab_domain, http_transport=http_transport)
+
+        self.loop_watchdog = LoopWatchdog()
+        self.loop_watchdog.start()
+
+        self.runtime_stats = RuntimeStats(
+            stats_path=self.STATS_PATH, loop_watchdog=self.loop_watchdog)
 
         self.telegram_service = TelegramService(
             chat_id=telegram_chat_id,
             token=telegram_token,
-            unassign_from_mr_callback=self.on_unassign_mr_decision)
+            unassign_from_mr_callback=self.on_unassign_mr_decision,
+            digest_window_in_sec=telegram_digest_window_in_sec,
+            webhook_url=telegram_webhook_url,
+            webhook_host=telegram_webhook_host,
+            webhook_port=telegram_webhook_port,
+            webhook_secret=telegram_webhook_secret,
+            ledger_path=self.NOTIFICATIONS_LEDGER_PATH,
+            runtime_stats=self.runtime_stats)
 
         self.merge_requests_labels = merge_requests_labels
 
+        self.dry_run_writes = dry_run_writes
+
+    async def close(self):
+        await self.loop_watchdog.stop()
+        await self.gitlab_api.http_service.close()
+        await self.telegram_service.close()
+
     def get_changed_notes(self, new_mr={"notes_map": {}}, old_mr={"notes_map": {}}):
         diffs = []
         logger.debug("get_changed_notes")
@@ -38,7 +75,7 @@ class Orchestrator:
         for note_id in new_mr["notes_map"].keys():
             if note_id not in old_mr["notes_map"]:
 
-                logger.debug(f"NEW comment: {new_mr['notes_map'][note_id]}")
+                logger.debug("NEW comment: %s", new_mr['notes_map'][note_id])
                 diffs.append(new_mr["notes_map"][note_id])
 
         filtered_notes = [
@@ -46,6 +83,7 @@ class Orchestrator:
 
         return filtered_notes
 
+    @timed
     def get_diff_notes(self, old_lookup_table={}, new_lookup_table={}):
         diffs = []
 
@@ -62,7 +100,7 @@ class Orchestrator:
 
                     if diff_notes:
                         logger.debug(
-                            f"mr notes changed: {new_lookup_table[mr_key]}")
+                            "mr notes changed: %s", new_lookup_table[mr_key])
 
                         diffs.append(
                             {
@@ -76,7 +114,7 @@ class Orchestrator:
 
                 if diff_notes:
                     logger.debug(
-                        f"mr notes changed: {new_lookup_table[mr_key]}")
+                        "mr notes changed: %s", new_lookup_table[mr_key])
                     diffs.append(
                         {
                             "mr": new_lookup_table[mr_key]['original_data'],
@@ -94,6 +132,7 @@ class Orchestrator:
         for mr in merge_requests_without_comments:
             logger.debug(f"{mr['title']} - {mr['web_url']}")
 
+    @timed
     def build_notes_lookup(self, merge_requests=[]):
         mr_lookup = {}
 
@@ -120,6 +159,7 @@ class Orchestrator:
 
         return mr_lookup
 
+    @timed
     async def telegram_notify_notes(self, diffs=None):
         for diff in diffs:
             mr = diff["mr"]
@@ -133,6 +173,7 @@ class Orchestrator:
                 else:
                     await self.telegram_service.send_system_note_message(note=note, mr=mr)
 
+    @timed
     async def fetch_and_save_relevant_merge_requests(self, project_ids=None):
         merge_requests = await self.gitlab_api.get_merge_requests_relevant_to_user(project_ids=project_ids)
 
@@ -142,9 +183,10 @@ class Orchestrator:
             "date": str(datetime.now())
         }
 
-        with open(self.MRS_DB_PATH, '+w', encoding="utf-8") as f:
-            f.write(json.dumps(db_object))
-            logger.info(f"Saved mrs to {self.MRS_DB_PATH} file")
+        with span(name="Orchestrator.save_db"):
+            with open(self.MRS_DB_PATH, '+w', encoding="utf-8") as f:
+                f.write(json.dumps(db_object))
+                logger.info(f"Saved mrs to {self.MRS_DB_PATH} file")
 
         return merge_requests
 
@@ -170,34 +212,41 @@ class Orchestrator:
 
         return merge_requests
 
-    @retry_on_fail
-    async def wait_for_comments(self, project_ids=[]):
+    async def load_initial_notes_lookup(self, project_ids=[]):
         await self.gitlab_api.get_current_user()
 
         all_merge_requests = await self.load_relevant_merge_requests_with_fallback(
             project_ids=project_ids)
 
-        prev_mrs_lookup = self.build_notes_lookup(
-            merge_requests=all_merge_requests)
+        return self.build_notes_lookup(merge_requests=all_merge_requests)
 
-        should_stop = False
+    async def check_for_new_comments(self, project_ids=[], prev_mrs_lookup={}):
+        async with self.runtime_stats.cycle(name="wait_for_comments"):
+            new_merge_requests = await self.fetch_and_save_relevant_merge_requests(project_ids=project_ids)
 
-        while not should_stop:
-            try:
-                new_merge_requests = await self.fetch_and_save_relevant_merge_requests(project_ids=project_ids)
+            fresh_mr_lookup = self.build_notes_lookup(
+                merge_requests=new_merge_requests)
 
-                fresh_mr_lookup = self.build_notes_lookup(
-                    merge_requests=new_merge_requests)
+            diff_notes = self.get_diff_notes(
+                new_lookup_table=fresh_mr_lookup, old_lookup_table=prev_mrs_lookup)
+            if diff_notes:
+                logger.info(
+                    f"Got {len(diff_notes)} merge requests with new comments")
 
-                diff_notes = self.get_diff_notes(
-                    new_lookup_table=fresh_mr_lookup, old_lookup_table=prev_mrs_lookup)
-                if diff_notes:
-                    logger.info(
-                        f"Got {len(diff_notes)} merge requests with new comments")
+                await self.telegram_notify_notes(diffs=diff_notes)
 
-                    await self.telegram_notify_notes(diffs=diff_notes)
+            return fresh_mr_lookup
 
-                prev_mrs_lookup = fresh_mr_lookup
+    @retry_on_fail
+    async def wait_for_comments(self, project_ids=[]):
+        prev_mrs_lookup = await self.load_initial_notes_lookup(project_ids=project_ids)
+
+        should_stop = False
+
+        while not should_stop:
+            try:
+                prev_mrs_lookup = await self.check_for_new_comments(project_ids=project_ids,
+                                                                    prev_mrs_lookup=prev_mrs_lookup)
 
             except Exception as e:
                 logger.error(e)
@@ -209,9 +258,40 @@ class Orchestrator:
 
             await asyncio.sleep(sleep_in_sec)
 
+    async def profile_comments_cycles(self, project_ids=[], cycles=1):
+        prev_mrs_lookup = await self.load_initial_notes_lookup(project_ids=project_ids)
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        try:
+            for cycle in range(cycles):
+                logger.info(f"Profiling wait_for_comments cycle {cycle + 1}/{cycles}")
+                prev_mrs_lookup = await self.check_for_new_comments(project_ids=project_ids,
+                                                                    prev_mrs_lookup=prev_mrs_lookup)
+
+            await self.telegram_service.flush()
+        finally:
+            profiler.disable()
+
+        report_path = f"{self.PROFILES_DIR}/profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+
+        profiler.dump_stats(f"{report_path}.prof")
+
+        with open(f"{report_path}.txt", '+w', encoding="utf-8") as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats("cumulative").print_stats(50)
+            stats.sort_stats("tottime").print_stats(30)
+
+        logger.info(f"Saved profile report to {report_path}.txt")
+        return report_path
+
     async def ensure_default_labels_exist_on_mrs(self):
         logger.debug("Checking if all mrs have default labels")
         mrs = await self.gitlab_api.get_merge_requests()
+        write_batch = self.gitlab_api.create_mr_write_batch(
+            dry_run=self.dry_run_writes)
+
         for mr in mrs:
             missing_labels = []
 
@@ -225,7 +305,9 @@ class Orchestrator:
                 logger.info(
                     f"Merge request {mr['title']} is missing labels: {missing_labels}. Updating")
                 labels_for_update = list(set(mr['labels'] + missing_labels))
-                await self.gitlab_api.update_mr_labels(labels=labels_for_update, iid=mr["iid"], project_id=mr["project_id"])
+                write_batch.stage(mr=mr, fields={"labels": labels_for_update})
+
+        await write_batch.execute()
 
     @retry_on_fail
     async def ensure_default_labels_loop(self):
@@ -247,31 +329,26 @@ class Orchestrator:
         await self.telegram_service.remove_reply_markup_from_message(message_id=message_id)
 
         if decision:
-            mrs = await self.gitlab_api.get_merge_requests_relevant_to_user(project_ids=[project_id])
+            mr = await self.gitlab_api.get_merge_request_with_notes(iid=mr_id, project_id=project_id)
 
-            for mr in mrs:
-                if mr["iid"] == mr_id:
-                    result = self.mr_should_be_unassigned_from(
-                        mr=mr, user=current_user)
+            if mr:
+                result = self.mr_should_be_unassigned_from(
+                    mr=mr, user=current_user)
 
-                    if result:
-                        if "assignee_ids" in result:
-                            logger.info(
-                                f"Removing user from mr assignees in MR: {mr['iid']}")
-                            await self.gitlab_api.update_mr_assignee_ids(iid=mr["iid"], project_id=mr["project_id"], assignee_ids=result["assignee_ids"])
+                if result:
+                    logger.info(
+                        f"Removing user from MR: {mr['iid']}. updated fields: {result}")
 
-                        if "reviewer_ids" in result:
-                            logger.info(
-                                f"Removing user from reviewers in MR: {mr['iid']}")
-                            await self.gitlab_api.update_mr_reviewer_ids(iid=mr["iid"], project_id=mr["project_id"], reviewer_ids=result["reviewer_ids"])
+                    write_batch = self.gitlab_api.create_mr_write_batch(
+                        dry_run=self.dry_run_writes)
+                    mr_key = write_batch.stage(
+                        mr=mr, fields=result, unsubscribe=True)
 
-                        await self.gitlab_api.unsubscribe_from_mr(iid=mr["iid"], project_id=mr["project_id"])
-                        logger.info(f"Unsubscribed from MR: {mr['iid']}")
+                    write_results = await write_batch.execute()
 
+                    if write_results[mr_key]["status"] in [WRITE_STATUS_UPDATED, WRITE_STATUS_NOOP]:
                         await self.telegram_service.unassign_from_mr_success(message_id=message_id)
 
-                    break
-
     def mr_should_be_unassigned_from(self, mr=None, user=None):
         result = None
         if len(mr["assignees"]) > 1 or len(mr["reviewers"]) > 1:
@@ -308,30 +385,32 @@ class Orchestrator:
 
         return result
 
-    async def check_relevant_mrs_to_unassign_and_send_notification(self, project_ids=[], current_user=None, sent_ids_set=None):
+    async def check_relevant_mrs_to_unassign_and_send_notification(self, project_ids=[], current_user=None):
         logger.debug(
             "Checking if user is assigned to not relevant merge requests")
 
-        mrs = await self.gitlab_api.get_merge_requests_relevant_to_user(project_ids=project_ids)
+        async with self.runtime_stats.cycle(name="unassign_from_mrs"):
+            mrs = await self.gitlab_api.get_merge_requests_relevant_to_user(project_ids=project_ids, with_notes=False)
 
-        for mr in mrs:
-            result = self.mr_should_be_unassigned_from(
-                mr=mr, user=current_user)
+            for mr in mrs:
+                # notes are only needed for mrs that are shared with somebody else
+                if "notes" not in mr and (len(mr["assignees"]) > 1 or len(mr["reviewers"]) > 1):
+                    await self.gitlab_api.load_merge_request_notes(mr=mr)
 
-            if result and mr["iid"] not in sent_ids_set:
-                await self.telegram_service.ask_to_unassign_from_mr(mr=mr)
-                sent_ids_set.add(mr["iid"])
+                result = self.mr_should_be_unassigned_from(
+                    mr=mr, user=current_user)
+
+                if result:
+                    # telegram_service skips mrs that were already asked about
+                    await self.telegram_service.ask_to_unassign_from_mr(mr=mr)
 
     @retry_on_fail
     async def unassign_from_mrs_loop(self, project_ids=[]):
         current_user = await self.gitlab_api.get_current_user()
 
-        sent_mrs_ids_set = set()
-
         while True:
             await self.check_relevant_mrs_to_unassign_and_send_notification(project_ids=project_ids,
-                                                                            current_user=current_user,
-                                                                            sent_ids_set=sent_mrs_ids_set)
+                                                                            current_user=current_user)
             sleep_in_sec = randint(50, 120)
 
             logger.debug(
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+from collections import deque
+
+
+class RateLimiter:
+    def __init__(self, limits=[]):
+        # list of (max_calls, period_in_sec) that all have to hold
+        self.limits = limits
+        self._longest_period = max([period for _, period in limits], default=0)
+        self._calls = deque()
+        self._lock = asyncio.Lock()
+
+    def _get_wait_time(self, now=None):
+        while self._calls and now - self._calls[0] >= self._longest_period:
+            self._calls.popleft()
+
+        wait_time = 0
+        for max_calls, period in self.limits:
+            recent_calls = [
+                call_time for call_time in self._calls if now - call_time < period]
+
+            if len(recent_calls) >= max_calls:
+                wait_time = max(
+                    wait_time, recent_calls[-max_calls] + period - now)
+
+        return wait_time
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                wait_time = self._get_wait_time(now=now)
+
+                if wait_time <= 0:
+                    self._calls.append(now)
+                    return
+
+                await asyncio.sleep(wait_time)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import asyncio
+import inspect
+import json
+import time
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+from src.logger import logger
+
+# spans of the cycle that is running in the current task, None outside of a cycle
+current_cycle_spans = ContextVar("current_cycle_spans", default=None)
+
+
+def percentile(values=[], fraction=0.5):
+    if not values:
+        return None
+
+    sorted_values = sorted(values)
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+
+    return sorted_values[index]
+
+
+def record_span(name=None, duration_in_sec=0):
+    spans = current_cycle_spans.get()
+
+    if spans is None:
+        return
+
+    span_stats = spans.setdefault(
+        name, {"count": 0, "total_ms": 0, "max_ms": 0})
+
+    duration_in_ms = duration_in_sec * 1000
+    span_stats["count"] += 1
+    span_stats["total_ms"] += duration_in_ms
+    span_stats["max_ms"] = max(span_stats["max_ms"], duration_in_ms)
+
+
+@contextmanager
+def span(name=None):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name=name, duration_in_sec=time.perf_counter() - started_at)
+
+
+def timed(func):
+    name = func.__qualname__
+
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper_func(*args, **kwargs):
+            with span(name=name):
+                return await func(*args, **kwargs)
+        return async_wrapper_func
+
+    @wraps(func)
+    def wrapper_func(*args, **kwargs):
+        with span(name=name):
+            return func(*args, **kwargs)
+    return wrapper_func
+
+
+class RuntimeStats:
+    def __init__(self, stats_path=None, history_size=100, loop_watchdog=None):
+        self.stats_path = stats_path
+        self.loop_watchdog = loop_watchdog
+        # cycle name -> last finished cycles, each {span name: {count, total_ms, max_ms}}
+        self.history = {}
+        self.history_size = history_size
+
+    @asynccontextmanager
+    async def cycle(self, name=None):
+        spans = {}
+        token = current_cycle_spans.set(spans)
+        started_at = time.perf_counter()
+
+        try:
+            yield spans
+        finally:
+            current_cycle_spans.reset(token)
+
+            spans[name] = {"count": 1, "total_ms": (time.perf_counter() - started_at) * 1000}
+            spans[name]["max_ms"] = spans[name]["total_ms"]
+
+            self.history.setdefault(name, deque(
+                maxlen=self.history_size)).append(spans)
+
+            logger.debug("%s cycle spans: %s", name, spans)
+
+            await self.save()
+
+    def summary(self):
+        cycles = {}
+
+        for cycle_name, cycles_spans in self.history.items():
+            spans_totals = {}
+
+            for spans in cycles_spans:
+                for span_name, span_stats in spans.items():
+                    spans_totals.setdefault(span_name, []).append(
+                        span_stats["total_ms"])
+
+            cycles[cycle_name] = {
+                "count": len(cycles_spans),
+                "last": cycles_spans[-1],
+                "spans": {
+                    span_name: {
+                        "p50_ms": percentile(totals, 0.5),
+                        "p95_ms": percentile(totals, 0.95),
+                        "max_ms": max(totals),
+                    } for span_name, totals in spans_totals.items()
+                }
+            }
+
+        summary = {"date": str(datetime.now()), "cycles": cycles}
+
+        if self.loop_watchdog:
+            summary["event_loop_lag"] = self.loop_watchdog.summary()
+
+        return summary
+
+    def _write(self, summary=None):
+        with open(self.stats_path, '+w', encoding="utf-8") as f:
+            f.write(json.dumps(summary, indent=2))
+
+    async def save(self):
+        if not self.stats_path:
+            return
+
+        try:
+            await asyncio.to_thread(self._write, self.summary())
+        except Exception as e:
+            logger.error(e)
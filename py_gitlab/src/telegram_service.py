@@ -1,104 +1,388 @@
 #!/usr/bin/env python3
 import json
 import asyncio
-from src.http_service import HttpService
-from src.logger import logger
-from src.utils import escape_chars_in_str
+import time
+from collections import OrderedDict
+from functools import partial
+from itertools import count
+from urllib.parse import urlparse
+from src.keyed_worker_pool import KeyedWorkerPool
+from src.http_service import HttpService, LANE_INTERACTIVE, LANE_LONG_POLL, use_lane
+from src.logger import logger, LazyJson
+from src.notification_ledger import NotificationLedger, EVENT_ASK_TO_UNASSIGN, note_event
+from src.rate_limiter import RateLimiter
+from src.runtime_stats import RuntimeStats, record_span, span
+from src.utils import escape_markdown_v2, escape_markdown_v2_url, truncate_escaped_str
+from src.webhook_server import WebhookServer
 
-CHARS_TO_ESCAPE = ["(", '-', '+', "_", "*", "[", "]", "`", ".", ')', "{", "}"]
+MAX_MESSAGE_LENGTH = 4096
+
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE_LIMITS = [(30, 1)]
+PRIVATE_CHAT_RATE_LIMITS = [(1, 1)]
+GROUP_CHAT_RATE_LIMITS = [(1, 1), (20, 60)]
+
+MAX_SEND_ATTEMPTS = 3
+
+OUTBOUND_STATS_CYCLE = "telegram_outbound"
+
+CALLBACK_WORKERS = 4
+MAX_SEEN_CALLBACK_QUERIES = 1000
 
 SERVICE_PREFIX = f"""```
-{escape_chars_in_str(input_str='[ gitlab ]',chars_to_escape=CHARS_TO_ESCAPE)}```"""
+{escape_markdown_v2(input_str='[ gitlab ]')}```"""
 
+USER_NOTE_TEMPLATE = SERVICE_PREFIX + \
+    "new comment on MR:\n[{title}]({url})\n\n_{body}_\n\n🗒 by {author}"
 
-def format_user_note_message(mr=None, note=None):
-    title_escaped = escape_chars_in_str(
-        input_str=mr['title'], chars_to_escape=CHARS_TO_ESCAPE)
+APPROVED_MR_NOTE_TEMPLATE = SERVICE_PREFIX + \
+    "MR was approved:\n[{title}]({url})\n\n🗒 by {author}"
 
-    body_escaped = escape_chars_in_str(
-        input_str=note['body'], chars_to_escape=CHARS_TO_ESCAPE)
+ASK_TO_UNASSIGN_FROM_MR_TEMPLATE = SERVICE_PREFIX + \
+    "Unassign user from MR?\n[{title}]({url})\n\nCreated by {author}"
 
-    note_url = f"{mr['web_url']}#note_{note['id']}"
-    url_formatted = f"[{title_escaped}]({note_url})"
+UNASSIGNED_SUCCESS_MESSAGE = SERVICE_PREFIX + "Unassigned ✅"
 
-    title = f"{SERVICE_PREFIX}new comment on MR:\n{url_formatted}"
-    body = f"_{body_escaped}_"
-    footer = f"🗒 by {note['author']['name']}"
+SYSTEM_NOTE_TEMPLATE = SERVICE_PREFIX + \
+    "🤖 event: \n[{title}]({url})\n\n_{body}_\n\n🗒 by {author}"
 
-    return f"{title}\n\n{body}\n\n{footer}"
+MR_DIGEST_TEMPLATE = SERVICE_PREFIX + \
+    "{count} updates on MR:\n[{title}]({url})\n\n{body}"
 
+DIGEST_LINE_TEMPLATES = {
+    "user": "🗒 {author}: _{body}_",
+    "approved": "✅ approved by {author}",
+    "system": "🤖 _{body}_ by {author}",
+}
 
-def format_approved_mr_note_message(mr=None, note=None):
-    title_escaped = escape_chars_in_str(
-        input_str=mr['title'], chars_to_escape=CHARS_TO_ESCAPE)
 
-    url_formatted = f"[{title_escaped}]({mr['web_url']})"
+def render_template(template=None, body=None, **fields):
+    if body is None:
+        return template.format(**fields)
 
-    title = f"{SERVICE_PREFIX}MR was approved:\n{url_formatted}"
-    footer = f"🗒 by {note['author']['name']}"
+    max_body_length = MAX_MESSAGE_LENGTH - \
+        len(template.format(body="", **fields))
 
-    return f"{title}\n\n{footer}"
+    return template.format(body=truncate_escaped_str(input_str=body, max_length=max_body_length), **fields)
 
 
-def format_ask_to_unassign_from_mr_message(mr=None):
-    title_escaped = escape_chars_in_str(
-        input_str=mr['title'], chars_to_escape=CHARS_TO_ESCAPE)
+def format_user_note_message(mr=None, note=None):
+    return render_template(template=USER_NOTE_TEMPLATE,
+                           title=escape_markdown_v2(input_str=mr['title']),
+                           url=escape_markdown_v2_url(
+                               input_str=f"{mr['web_url']}#note_{note['id']}"),
+                           author=escape_markdown_v2(
+                               input_str=note['author']['name']),
+                           body=escape_markdown_v2(input_str=note['body']))
+
 
-    url_formatted = f"[{title_escaped}]({mr['web_url']})"
+def format_approved_mr_note_message(mr=None, note=None):
+    return render_template(template=APPROVED_MR_NOTE_TEMPLATE,
+                           title=escape_markdown_v2(input_str=mr['title']),
+                           url=escape_markdown_v2_url(input_str=mr['web_url']),
+                           author=escape_markdown_v2(input_str=note['author']['name']))
 
-    title = f"{SERVICE_PREFIX}Unassign user from MR?\n{url_formatted}"
-    footer = f"Created by {mr['author']['name']}"
 
-    return f"{title}\n\n{footer}"
+def format_ask_to_unassign_from_mr_message(mr=None):
+    return render_template(template=ASK_TO_UNASSIGN_FROM_MR_TEMPLATE,
+                           title=escape_markdown_v2(input_str=mr['title']),
+                           url=escape_markdown_v2_url(input_str=mr['web_url']),
+                           author=escape_markdown_v2(input_str=mr['author']['name']))
 
 
 def format_unassigned_success():
-    return f"{SERVICE_PREFIX}Unassigned ✅"
+    return UNASSIGNED_SUCCESS_MESSAGE
 
 
 def format_system_note_message(mr=None, note=None):
-    title_escaped = escape_chars_in_str(
-        input_str=mr['title'], chars_to_escape=CHARS_TO_ESCAPE)
+    return render_template(template=SYSTEM_NOTE_TEMPLATE,
+                           title=escape_markdown_v2(input_str=mr['title']),
+                           url=escape_markdown_v2_url(input_str=mr['web_url']),
+                           author=escape_markdown_v2(
+                               input_str=note['author']['name']),
+                           body=escape_markdown_v2(input_str=note['body']))
+
+
+def format_note_digest_line(note=None, kind=None, max_length=None):
+    template = DIGEST_LINE_TEMPLATES[kind]
+    author = escape_markdown_v2(input_str=note['author']['name'])
+    body = escape_markdown_v2(input_str=note['body'])
+
+    line = template.format(author=author, body=body)
+
+    if max_length is None or len(line) <= max_length:
+        return line
+
+    # cut the body only, so the line keeps its formatting
+    max_body_length = max(max_length - len(template.format(author=author, body="")), 0)
+
+    return template.format(author=author, body=truncate_escaped_str(input_str=body, max_length=max_body_length))
+
+
+def format_mr_digest_message(mr=None, entries=[]):
+    fields = {
+        "count": len(entries),
+        "title": escape_markdown_v2(input_str=mr['title']),
+        "url": escape_markdown_v2_url(input_str=mr['web_url']),
+    }
+
+    max_body_length = MAX_MESSAGE_LENGTH - \
+        len(MR_DIGEST_TEMPLATE.format(body="", **fields))
+
+    def more_mark(remaining=0):
+        return escape_markdown_v2(input_str=f"… and {remaining} more")
+
+    # the first line is always shown, cut if needed, later lines that don't fit are
+    # dropped whole, with room kept for the "… and N more" tail
+    lines = []
+    body_length = 0
+    for index, (kind, note) in enumerate(entries):
+        remaining = len(entries) - index - 1
+        separator_length = 2 if lines else 0
+        reserved_length = len(more_mark(remaining=remaining)) + 2 if remaining else 0
+        available_length = max_body_length - body_length - separator_length - reserved_length
+
+        line = format_note_digest_line(note=note, kind=kind)
+
+        if len(line) > available_length:
+            if lines:
+                lines.append(more_mark(remaining=remaining + 1))
+                break
+
+            line = format_note_digest_line(
+                note=note, kind=kind, max_length=available_length)
+
+        lines.append(line)
+        body_length += separator_length + len(line)
+
+    return MR_DIGEST_TEMPLATE.format(body="\n\n".join(lines), **fields)
+
 
-    body_escaped = escape_chars_in_str(
-        input_str=note['body'], chars_to_escape=CHARS_TO_ESCAPE)
+NOTE_FORMATTERS = {
+    "user": format_user_note_message,
+    "approved": format_approved_mr_note_message,
+    "system": format_system_note_message,
+}
 
-    url_formatted = f"[{title_escaped}]({mr['web_url']})"
 
-    title = f"{SERVICE_PREFIX}🤖 event: \n{url_formatted}"
-    body = f"_{body_escaped}_"
-    footer = f"🗒 by {note['author']['name']}"
+def get_retry_after(response=None):
+    if isinstance(response, dict) and response.get("error_code") == 429:
+        return response.get("parameters", {}).get("retry_after", 1)
 
-    return f"{title}\n\n{body}\n\n{footer}"
+    return None
 
 
 class TelegramService:
-    def __init__(self, chat_id=None, token=None, unassign_from_mr_callback=None):
+    def __init__(self,
+                 chat_id=None,
+                 token=None,
+                 unassign_from_mr_callback=None,
+                 digest_window_in_sec=0,
+                 webhook_url=None,
+                 webhook_host="127.0.0.1",
+                 webhook_port=8443,
+                 webhook_secret=None,
+                 ledger_path=None,
+                 runtime_stats=None):
         self.chat_id = chat_id
         self.token = token
 
-        self.http_service = HttpService()
+        self.http_service = HttpService(default_lane=LANE_INTERACTIVE)
 
         self.unassign_from_mr_callback = unassign_from_mr_callback
 
-        asyncio.ensure_future(self._run_updates_loop())
+        self.digest_window_in_sec = digest_window_in_sec
+        # (project_id, iid) -> {"mr": mr, "entries": [(kind, note)], "priority": int}
+        self.pending_digests = {}
+
+        self.outbound_queue = asyncio.PriorityQueue()
+        self._outbound_seq = count()
+
+        self.global_rate_limiter = RateLimiter(limits=GLOBAL_RATE_LIMITS)
+        self.chat_rate_limiters = {}
+
+        self.webhook_url = webhook_url
+        self.webhook_host = webhook_host
+        self.webhook_port = webhook_port
+        self.webhook_secret = webhook_secret
+        self.webhook_server = None
+
+        self.callback_workers = KeyedWorkerPool(workers=CALLBACK_WORKERS)
+        self.seen_callback_query_ids = OrderedDict()
+
+        # sends are idempotent per (project_id, iid, event), across restarts too
+        self.ledger = NotificationLedger(path=ledger_path)
+        self.queued_ledger_keys = set()
+
+        # sends run outside of the cycle that queued them, so they get their own series
+        self.runtime_stats = runtime_stats or RuntimeStats()
+
+        asyncio.ensure_future(self._run_outbound_loop())
+        asyncio.ensure_future(self._start_updates_receiver())
 
     async def send_user_note(self, note=None, mr=None):
-        note_body = format_user_note_message(note=note, mr=mr)
-        await self._send_message(body=note_body)
+        self._enqueue_note(kind="user", note=note, mr=mr,
+                           priority=PRIORITY_HIGH)
 
     async def send_system_note_message(self, note=None, mr=None):
-        note_body = format_system_note_message(note=note, mr=mr)
-
-        await self._send_message(body=note_body)
+        self._enqueue_note(kind="system", note=note, mr=mr,
+                           priority=PRIORITY_LOW)
 
     async def send_mr_approved_note_message(self, note=None, mr=None):
-        note_body = format_approved_mr_note_message(note=note, mr=mr)
+        self._enqueue_note(kind="approved", note=note, mr=mr,
+                           priority=PRIORITY_HIGH)
+
+    def _claim_ledger_key(self, ledger_key=None):
+        # False when this notification was already sent or is waiting in the queue
+        project_id, iid, event = ledger_key
+
+        if ledger_key in self.queued_ledger_keys or self.ledger.contains(project_id=project_id, iid=iid, event=event):
+            logger.debug(f"Skipping already sent notification: {ledger_key}")
+            return False
+
+        self.queued_ledger_keys.add(ledger_key)
+        return True
+
+    def _enqueue_note(self, kind=None, note=None, mr=None, priority=PRIORITY_LOW):
+        ledger_key = (mr["project_id"], mr["iid"], note_event(note=note))
+
+        if not self._claim_ledger_key(ledger_key=ledger_key):
+            return
+
+        if not self.digest_window_in_sec:
+            body = NOTE_FORMATTERS[kind](note=note, mr=mr)
+            self._enqueue_message(body=body, priority=priority,
+                                  ledger_keys=[ledger_key])
+            return
+
+        mr_key = (mr["project_id"], mr["iid"])
+
+        if mr_key not in self.pending_digests:
+            self.pending_digests[mr_key] = {
+                "mr": mr, "entries": [], "priority": priority, "ledger_keys": []}
+            asyncio.ensure_future(self._flush_digest_later(mr_key=mr_key))
+
+        digest = self.pending_digests[mr_key]
+        digest["mr"] = mr
+        digest["entries"].append((kind, note))
+        digest["ledger_keys"].append(ledger_key)
+        digest["priority"] = min(digest["priority"], priority)
+
+    async def _flush_digest_later(self, mr_key=None):
+        await asyncio.sleep(self.digest_window_in_sec)
+
+        digest = self.pending_digests.pop(mr_key, None)
+        if not digest:
+            return
+
+        if len(digest["entries"]) == 1:
+            kind, note = digest["entries"][0]
+            body = NOTE_FORMATTERS[kind](note=note, mr=digest["mr"])
+        else:
+            body = format_mr_digest_message(
+                mr=digest["mr"], entries=digest["entries"])
+
+        self._enqueue_message(
+            body=body, priority=digest["priority"], ledger_keys=digest["ledger_keys"])
+
+    def _enqueue_message(self, body=None, priority=PRIORITY_LOW, ledger_keys=[], **kwargs):
+        future = asyncio.get_running_loop().create_future()
+
+        self.outbound_queue.put_nowait(
+            (priority, next(self._outbound_seq), time.monotonic(), body, kwargs, ledger_keys, future))
+
+        return future
+
+    async def _run_outbound_loop(self):
+        while True:
+            _, _, enqueued_at, body, kwargs, ledger_keys, future = await self.outbound_queue.get()
+
+            res = None
+            async with self.runtime_stats.cycle(name=OUTBOUND_STATS_CYCLE):
+                record_span(name="TelegramService.queue_wait",
+                            duration_in_sec=time.monotonic() - enqueued_at)
+                try:
+                    res = await self._send_message(body=body, **kwargs)
+                except Exception as e:
+                    logger.error(e)
+
+            for project_id, iid, event in ledger_keys:
+                self.queued_ledger_keys.discard((project_id, iid, event))
+
+                if res and res.get("ok"):
+                    self.ledger.add(project_id=project_id, iid=iid, event=event)
 
-        await self._send_message(body=note_body)
+            if not future.done():
+                future.set_result(res)
+
+            self.outbound_queue.task_done()
+
+    async def close(self):
+        await self.callback_workers.close()
+        await self.ledger.save()
+
+        if self.webhook_server:
+            await self.webhook_server.stop()
+
+        await self.http_service.close()
+
+    async def flush(self):
+        # waits for digests that are still collecting notes and everything queued so far
+        while self.pending_digests:
+            await asyncio.sleep(self.digest_window_in_sec)
+
+        await self.outbound_queue.join()
+
+    def _get_chat_rate_limiter(self, chat_id=None):
+        if chat_id not in self.chat_rate_limiters:
+            limits = GROUP_CHAT_RATE_LIMITS if str(
+                chat_id).startswith("-") else PRIVATE_CHAT_RATE_LIMITS
+            self.chat_rate_limiters[chat_id] = RateLimiter(limits=limits)
+
+        return self.chat_rate_limiters[chat_id]
+
+    async def _post_to_chat(self, method=None, json_payload=None):
+        url = f"https://api.telegram.org/{self.token}/{method}"
+
+        logger.debug("%s", LazyJson(json_payload))
+
+        res = None
+        for _ in range(MAX_SEND_ATTEMPTS):
+            with span(name="TelegramService.rate_limit_wait"):
+                await self._get_chat_rate_limiter(chat_id=json_payload["chat_id"]).acquire()
+                await self.global_rate_limiter.acquire()
+
+            try:
+                with span(name=f"TelegramService.{method}"):
+                    res = await self.http_service.post(url=url, json_body=json_payload)
+                logger.debug(res)
+            except Exception as e:
+                logger.error(e)
+
+            retry_after = get_retry_after(response=res)
+            if retry_after is None:
+                break
+
+            logger.warning(
+                f"Telegram rate limit hit on {method}. Retrying after {retry_after} sec")
+            await asyncio.sleep(retry_after)
+
+        return res
+
+    async def _call_bot_api(self, method=None, json_payload=None):
+        url = f"https://api.telegram.org/{self.token}/{method}"
+
+        try:
+            res = await self.http_service.post(url=url, json_body=json_payload)
+            logger.debug(res)
+            return res
+        except Exception as e:
+            logger.error(e)
 
     async def _send_message(self, body=None, **kwargs):
-        url = f"https://api.telegram.org/{self.token}/sendMessage"
         json_payload = {
             "text": body,
             "chat_id": self.chat_id,
@@ -106,16 +390,9 @@ class TelegramService:
             **kwargs
         }
 
-        logger.debug(json.dumps(json_payload, indent=2))
-
-        try:
-            res = await self.http_service.post(url=url, json_body=json_payload)
-            logger.debug(res)
-        except Exception as e:
-            logger.error(e)
+        return await self._post_to_chat(method="sendMessage", json_payload=json_payload)
 
     async def remove_reply_markup_from_message(self, message_id=None):
-        url = f"https://api.telegram.org/{self.token}/editMessageReplyMarkup"
         json_payload = {
             "chat_id": self.chat_id,
             "message_id": message_id,
@@ -123,15 +400,14 @@ class TelegramService:
                 "inline_keyboard": []}
         }
 
-        logger.debug(json.dumps(json_payload, indent=2))
-
-        try:
-            res = await self.http_service.post(url=url, json_body=json_payload)
-            logger.debug(res)
-        except Exception as e:
-            logger.error(e)
+        return await self._post_to_chat(method="editMessageReplyMarkup", json_payload=json_payload)
 
     async def ask_to_unassign_from_mr(self, mr=None):
+        ledger_key = (mr["project_id"], mr["iid"], EVENT_ASK_TO_UNASSIGN)
+
+        if not self._claim_ledger_key(ledger_key=ledger_key):
+            return None
+
         body = format_ask_to_unassign_from_mr_message(mr=mr)
 
         markup = {"inline_keyboard": [
@@ -144,23 +420,66 @@ class TelegramService:
                 "callback_data": json.dumps({"mr_id": mr["iid"], "project_id":mr["project_id"], "decision":False})
             }],
         ]}
-        return await self._send_message(body=body, reply_markup=markup)
+        return await self._enqueue_message(body=body, priority=PRIORITY_HIGH, ledger_keys=[ledger_key], reply_markup=markup)
 
     async def _get_updates(self, time_out=0, offset=0):
         url = f"https://api.telegram.org/{self.token}/getUpdates"
         query_params = {"timeout": time_out, "offset": offset}
 
         try:
-            res = await self.http_service.get(url=url, query_params=query_params)
+            res = await self.http_service.get(url=url, query_params=query_params, lane=LANE_LONG_POLL)
             logger.debug(res)
             return res
         except Exception as e:
             logger.error(e)
 
     async def unassign_from_mr_success(self, message_id=None):
-        await self._send_message(body=format_unassigned_success(), reply_to_message_id=message_id)
+        await self._enqueue_message(body=format_unassigned_success(), priority=PRIORITY_HIGH, reply_to_message_id=message_id)
+
+    async def _start_updates_receiver(self):
+        if self.webhook_url and await self._start_webhook():
+            return
+
+        await self._run_updates_loop()
+
+    async def _start_webhook(self):
+        self.webhook_server = WebhookServer(
+            path=urlparse(self.webhook_url).path or "/",
+            secret_token=self.webhook_secret,
+            on_update=self._process_webhook_update)
+
+        try:
+            await self.webhook_server.start(host=self.webhook_host, port=self.webhook_port)
+        except Exception as e:
+            logger.error(e)
+            logger.warning(
+                "Failed to start webhook server. Falling back to getUpdates polling")
+            self.webhook_server = None
+            return False
+
+        res = await self._call_bot_api(method="setWebhook", json_payload={
+            "url": self.webhook_url,
+            "secret_token": self.webhook_secret,
+            "allowed_updates": ["callback_query"]
+        })
+
+        if not res or not res.get("ok"):
+            logger.warning(
+                f"Failed to register webhook: {res}. Falling back to getUpdates polling")
+            await self.webhook_server.stop()
+            self.webhook_server = None
+            return False
+
+        logger.info(f"Receiving telegram updates via webhook: {self.webhook_url}")
+        return True
+
+    async def _process_webhook_update(self, update=None):
+        await self._process_updates([update])
 
     async def _run_updates_loop(self):
+        # getUpdates is rejected by telegram while a webhook is registered
+        await self._call_bot_api(method="deleteWebhook")
+
         poll_timeout = 20
         logger.info(
             f"Polling getUpdates for updates with timeout: {poll_timeout}")
@@ -169,22 +488,60 @@ class TelegramService:
         while True:
             new_updates = await self._get_updates(time_out=poll_timeout, offset=offset)
 
-            if new_updates:
+            if new_updates and new_updates.get("ok"):
                 for update in new_updates["result"]:
                     offset = max(offset, update["update_id"]+1)
 
                 await self._process_updates(new_updates["result"])
 
+    async def _answer_callback_query(self, callback_query_id=None, text=None):
+        json_payload = {"callback_query_id": callback_query_id}
+        if text:
+            json_payload["text"] = text
+
+        return await self._call_bot_api(method="answerCallbackQuery", json_payload=json_payload)
+
+    def _is_seen_callback_query(self, callback_query_id=None):
+        if callback_query_id in self.seen_callback_query_ids:
+            return True
+
+        self.seen_callback_query_ids[callback_query_id] = True
+        if len(self.seen_callback_query_ids) > MAX_SEEN_CALLBACK_QUERIES:
+            self.seen_callback_query_ids.popitem(last=False)
+
+        return False
+
+    async def _run_unassign_callback(self, data=None, message=None):
+        # gitlab calls made on behalf of a button press skip the bulk queue
+        with use_lane(LANE_INTERACTIVE):
+            await self.unassign_from_mr_callback(
+                mr_id=data["mr_id"], project_id=data["project_id"], decision=data['decision'], message=message)
+
     async def _process_updates(self, updates=[]):
+        # only dispatches, so the next poll isn't held up by slow callbacks
         for update in updates:
             logger.info(f"Received new update: {update['update_id']}")
 
             try:
-                data = json.loads(update["callback_query"]["data"])
+                callback_query = update["callback_query"]
+
+                if self._is_seen_callback_query(callback_query_id=callback_query["id"]):
+                    continue
+
+                asyncio.ensure_future(self._answer_callback_query(
+                    callback_query_id=callback_query["id"], text="Working on it"))
+
+                data = json.loads(callback_query["data"])
 
                 if "mr_id" in data and "project_id" in data and "decision" in data:
-                    await self.unassign_from_mr_callback(
-                        mr_id=data["mr_id"], project_id=data["project_id"], decision=data['decision'], message=update["callback_query"]["message"])
+                    submitted = self.callback_workers.submit(
+                        key=(data["project_id"], data["mr_id"]),
+                        job_id=data["decision"],
+                        job_factory=partial(self._run_unassign_callback, data=data, message=callback_query["message"]))
+
+                    if not submitted:
+                        logger.info(
+                            f"Ignoring repeated press for mr: {data['mr_id']}")
 
             except Exception as e:
                 logger.error(e)
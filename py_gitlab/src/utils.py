@@ -2,23 +2,55 @@
 import re
 import hashlib
 import asyncio
-from functools import wraps
+from functools import wraps, lru_cache
 from typing import List
 from src.logger import logger
 
 
+# https://core.telegram.org/bots/api#markdownv2-style
+MARKDOWN_V2_SPECIAL_CHARS = "\\_*[]()~`>#+-=|{}.!"
+MARKDOWN_V2_URL_SPECIAL_CHARS = "\\)"
+
+TRUNCATION_MARK = "…"
+
+
+@lru_cache(maxsize=None)
+def _get_escape_table(chars_to_escape="", escape_with="\\"):
+    # one translate table maps every char to its escaped form, so a string is scanned only once
+    return str.maketrans({char: f"{escape_with}{char}" for char in chars_to_escape})
+
+
 def escape_char_in_str(input_str=None, char_to_escape=None, escape_with="\\"):
-    return re.sub(f"\{char_to_escape}", f'{escape_with}{char_to_escape}', input_str)
+    return escape_chars_in_str(input_str=input_str, chars_to_escape=[char_to_escape], escape_with=escape_with)
 
 
 def escape_chars_in_str(input_str='', chars_to_escape=[], escape_with="\\"):
-    result = input_str
+    table = _get_escape_table(
+        chars_to_escape="".join(chars_to_escape), escape_with=escape_with)
+
+    return input_str.translate(table)
+
+
+def escape_markdown_v2(input_str=''):
+    return escape_chars_in_str(input_str=input_str, chars_to_escape=MARKDOWN_V2_SPECIAL_CHARS)
+
+
+def escape_markdown_v2_url(input_str=''):
+    return escape_chars_in_str(input_str=input_str, chars_to_escape=MARKDOWN_V2_URL_SPECIAL_CHARS)
+
+
+def truncate_escaped_str(input_str='', max_length=0):
+    if len(input_str) <= max_length:
+        return input_str
+
+    result = input_str[:max(max_length - len(TRUNCATION_MARK), 0)]
 
-    for char_to_escape in chars_to_escape:
-        result = escape_char_in_str(
-            input_str=result, char_to_escape=char_to_escape, escape_with=escape_with)
+    # don't leave a dangling escape character at the cut
+    trailing_escapes = len(result) - len(result.rstrip("\\"))
+    if trailing_escapes % 2:
+        result = result[:-1]
 
-    return result
+    return f"{result}{TRUNCATION_MARK}"
 
 
 def retry_on_fail(func):
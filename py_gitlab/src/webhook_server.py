@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import asyncio
+import hmac
+from aiohttp import web
+from src.logger import logger
+
+TELEGRAM_SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    def __init__(self, path="/", secret_token=None, on_update=None):
+        self.path = path
+        self.secret_token = secret_token
+        self.on_update = on_update
+
+        self.runner = None
+
+    async def _handle_update(self, request):
+        received_token = request.headers.get(TELEGRAM_SECRET_TOKEN_HEADER, "")
+
+        # compare_digest only takes ascii str, headers can carry anything
+        if not self.secret_token or not hmac.compare_digest(
+                received_token.encode("utf-8", "surrogateescape"), self.secret_token.encode("utf-8")):
+            logger.warning(
+                f"Rejected webhook request from {request.remote}: bad secret token")
+            return web.Response(status=401)
+
+        try:
+            update = await request.json()
+        except Exception as e:
+            logger.error(e)
+            return web.Response(status=400)
+
+        # answer telegram right away, processing happens in the background
+        asyncio.ensure_future(self.on_update(update))
+
+        return web.Response(status=200)
+
+    async def start(self, host="127.0.0.1", port=8443):
+        app = web.Application()
+        app.router.add_post(self.path, self._handle_update)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+
+        site = web.TCPSite(self.runner, host=host, port=port)
+        await site.start()
+
+        logger.info(f"Listening for telegram webhooks on {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
@@ -9,6 +9,10 @@ setup(
         'asyncio == 3.4.3',
         'aiohttp == 3.8.1',
     ],
+    extras_require={
+        'http2': ['httpx[http2]'],
+        'bench': ['httpx[http2]', 'hypercorn'],
+    },
     entry_points={
         'console_scripts': [
             'py_gitlab = src.cli:main',